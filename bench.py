@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# 帧流水线基准测试：不需要实体屏幕，全部使用合成素材和模拟 USB 端点。
+# 用法: python bench.py [--duration 3] [--latency 0.025] [--only video] [--json out.json]
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import main
+
+# --- 隔离环境：设置文件和帧缓存放到临时目录，不碰 main.py 旁边的真实文件 ---
+TMP_DIR = tempfile.mkdtemp(prefix="deepcool-bench-")
+main.CONFIG_FILE = os.path.join(TMP_DIR, "settings.json")
+main.SETTINGS = main.SettingsStore(main.CONFIG_FILE)
+
+def percentiles(samples):
+    if not samples: return {"p50_ms": None, "p90_ms": None, "p99_ms": None, "max_ms": None}
+    data = sorted(samples)
+    pick = lambda q: round(data[min(len(data) - 1, int(q * len(data)))] * 1000, 3)
+    return {"p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": round(data[-1] * 1000, 3)}
+
+class SyntheticMonitor:
+    # 替代 SystemMonitor：每次 tick 数值都变化，保证监控界面每帧都要重绘
+    hostname = "bench-host"
+
+    def __init__(self):
+        self.t = 0
+        self.usage_history = [float(i % 100) for i in range(main.SystemMonitor.GRAPH_POINTS)]
+
+    def tick(self):
+        self.t += 1
+        self.usage_history = self.usage_history[1:] + [float(self.t * 13 % 100)]
+
+    def get_cpu_temp(self): return 35.0 + self.t * 7 % 55
+    def get_cpu_usage(self): return float(self.t * 13 % 100)
+    def get_cpu_power(self): return 15.0 + self.t * 3 % 140
+    def get_uptime_str(self): return f"UP: 01:{self.t // 60 % 60:02}:{self.t % 60:02}"
+    def get_total_runtime_str(self): return f"TOT: {100 + self.t // 3600}H"
+
+def make_media(video_size, video_frames):
+    # 合成素材：带运动渐变和噪点的 MJPG 视频，以及一张 1080p 静态图
+    import cv2
+    import numpy as np
+    w, h = video_size
+    video = os.path.join(TMP_DIR, f"synthetic_{w}x{h}.avi")
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*"MJPG"), 30, (w, h))
+    rng = np.random.default_rng(0)
+    xs = np.linspace(0, 255, w, dtype=np.float32)
+    for i in range(video_frames):
+        frame = np.empty((h, w, 3), dtype=np.uint8)
+        frame[..., 0] = (xs + i * 8) % 256
+        frame[..., 1] = np.linspace(0, 255, h, dtype=np.uint8)[:, None]
+        frame[..., 2] = rng.integers(0, 256, (h, w), dtype=np.uint8)
+        writer.write(frame)
+    writer.release()
+    image = os.path.join(TMP_DIR, "synthetic_1080p.jpg")
+    cv2.imwrite(image, rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8))
+    return video, image
+
+# --- 正确性校验：快速路径必须和逐像素参考实现逐字节一致，否则计时没有意义 ---
+def check_encoders():
+    import cv2
+    import numpy as np
+    rgb = np.random.default_rng(2).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    expected = bytes(main.encode_rgb565_reference(main.Image.fromarray(rgb)))
+    checks = {
+        "encode_rgb565 PIL": main.encode_rgb565(main.Image.fromarray(rgb)),
+        "encode_rgb565 ndarray (BGR)": main.encode_rgb565(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), bgr=True),
+        # 0.999 时查找表取整后是恒等映射，但走的是查找表路径
+        "Rgb565Encoder.encode LUT path": main.Rgb565Encoder(0.999).encode(rgb),
+    }
+    for name, got in checks.items():
+        if got != expected: raise SystemExit(f"Encoder mismatch: {name} differs from encode_rgb565_reference")
+
+# --- 单项基准 ---
+def run_micro(name, fn, iterations, warmup=5):
+    for _ in range(warmup): fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    total = sum(samples)
+    return {"name": name, "n": iterations, "fps": round(iterations / total, 1) if total else None, **percentiles(samples)}
+
+def micro_benchmarks(iterations, image_path):
+    import cv2
+    import numpy as np
+    screen = main.DeepCoolScreen(backend=main.NullEndpoint())
+    monitor = SyntheticMonitor()
+    renderer = main.MonitorRenderer(screen)
+    encoder = main.Rgb565Encoder()
+    dimmed = main.Rgb565Encoder()
+    dimmed.set_level(0.5)
+    rng = np.random.default_rng(1)
+    frame_1080 = rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8)
+    frame_4k = rng.integers(0, 256, (2160, 3840, 3), dtype=np.uint8)
+    panel_bgr = rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    panel_pil = main.Image.fromarray(cv2.cvtColor(panel_bgr, cv2.COLOR_BGR2RGB))
+    encoded = main.encode_rgb565(panel_bgr, bgr=True)
+    same, differ = bytes(encoded), encoded[:-1] + bytes([encoded[-1] ^ 1])
+
+    def render():
+        monitor.tick()
+        renderer.render(monitor, encoder)
+
+    def display():
+        render()
+        screen.display(bytes(renderer.frame))
+
+    cases = [
+        ("draw_monitor_ui (full redraw)", lambda: (monitor.tick(), main.draw_monitor_ui(screen, monitor))),
+        ("MonitorRenderer.render (dirty regions)", render),
+        ("process_frame_cv2 1080p -> PIL", lambda: main.process_frame_cv2(frame_1080)),
+        ("process_frame_cv2 4K -> PIL", lambda: main.process_frame_cv2(frame_4k)),
+        ("fit_frame_cv2 1080p contain", lambda: main.fit_frame_cv2(frame_1080)),
+        ("fit_frame_cv2 1080p cover", lambda: main.fit_frame_cv2(frame_1080, mode='cover')),
+        ("encode_rgb565 ndarray (BGR)", lambda: main.encode_rgb565(panel_bgr, bgr=True)),
+        ("encode_rgb565 PIL", lambda: main.encode_rgb565(panel_pil)),
+        ("Rgb565Encoder.encode brightness 50%", lambda: dimmed.encode(panel_bgr, bgr=True)),
+        ("Rgb565Encoder.apply brightness 100%", lambda: encoder.apply(encoded)),
+        ("Rgb565Encoder.apply brightness 50%", lambda: dimmed.apply(encoded)),
+        ("dedupe compare (identical frame)", lambda: same == encoded),
+        ("dedupe compare (last byte differs)", lambda: differ == encoded),
+        ("static image decode + fit", lambda: main.process_frame_cv2(cv2.imread(image_path))),
+        ("render + display (null endpoint)", display),
+    ]
+    return [run_micro(name, fn, iterations) for name, fn in cases]
+
+# --- 端到端：FrameProducer -> FramePipeline -> 模拟端点 ---
+def run_pipeline(name, mode, duration, args, media=None, ram=True):
+    endpoint = main.MockEndpoint(latency=args.latency, bandwidth=args.bandwidth)
+    screen = main.DeepCoolScreen(backend=endpoint)
+    state = main.ServiceState()
+    state.frame_cache = main.FrameCache(os.path.join(TMP_DIR, "cache"))
+    if not ram: state.ram_budget = 0
+    if media:
+        loaded, msg = state.load_media(media, decoder=args.decoder)
+        if not loaded: raise RuntimeError(f"{name}: {msg}")
+        loaded.needs_cache = False  # 不在测量期间后台转码换源
+        state.apply_media(loaded, persist=False)
+    else:
+        state.show_monitor(persist=False)
+    monitor = SyntheticMonitor()
+    renderer = main.MonitorRenderer(screen)
+    pipeline = main.FramePipeline(screen)
+    scheduler = main.FrameScheduler(pipeline)
+    state.pipeline, state.scheduler = pipeline, scheduler
+    producer = main.FrameProducer(state, renderer, scheduler, monitor)
+    # 测吞吐：每次只取下一帧，不让调度器因为"落后于源帧率"而跳帧
+    scheduler.frames_to_skip = lambda key, fps: 0
+    if ram and state.frame_store:
+        # 内存帧库场景测的是首轮填满之后的循环播放
+        while state.frame_store and not state.frame_store.complete: main.next_video_frame(state)
+
+    write_times = []
+    display = screen.display
+    def timed_display(buf):
+        start = time.perf_counter()
+        written = display(buf)
+        if written: write_times.append(time.perf_counter() - start)
+        return written
+    screen.display = timed_display
+    pipeline.start()
+
+    produce_times, produced, levels = [], 0, (1.0, 0.5)
+    written_before = endpoint.frames
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        # 监控界面每帧数值都变；静态图每帧切换亮度，迫使重新编码
+        if mode == "MONITOR": monitor.tick()
+        elif mode == "STATIC": state.set_brightness(levels[produced % 2])
+        t0 = time.perf_counter()
+        buf, _ = producer.produce()
+        elapsed = time.perf_counter() - t0
+        if buf is None: continue
+        produce_times.append(elapsed)
+        # 背压：队列满时等写线程腾出位置，测的是整条流水线的持续吞吐而不是丢帧速度
+        queue = pipeline.queue
+        while len(queue.items) >= queue.maxsize and time.perf_counter() - start < duration: time.sleep(0.0005)
+        pipeline.submit(buf, elapsed)
+        produced += 1
+    total = time.perf_counter() - start
+    time.sleep(0.05)
+    state._cleanup()
+    row = {"name": name, "n": produced, "fps": round(produced / total, 1),
+           "written_fps": round((endpoint.frames - written_before) / total, 1),
+           "dropped": pipeline.queue.snapshot()["dropped"], **percentiles(produce_times)}
+    row["write"] = percentiles(write_times)
+    return row
+
+def pipeline_benchmarks(duration, args, video, image):
+    return [
+        run_pipeline("MONITOR end-to-end", "MONITOR", duration, args),
+        run_pipeline("STATIC end-to-end (re-encode)", "STATIC", duration, args, media=image),
+        run_pipeline("VIDEO end-to-end (decode)", "VIDEO", duration, args, media=video, ram=False),
+        run_pipeline("VIDEO end-to-end (RAM store)", "VIDEO", duration, args, media=video),
+    ]
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"  {'benchmark':<42} {'per sec':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    fmt = lambda v: f"{v:>9}" if v is not None else f"{'-':>9}"
+    for r in rows:
+        print(f"  {r['name']:<42} {fmt(r['fps'])} {fmt(r['p50_ms'])} {fmt(r['p90_ms'])} {fmt(r['p99_ms'])} {fmt(r['max_ms'])}")
+        if "write" in r:
+            w = r["write"]
+            print(f"  {'  -> written ' + str(r['written_fps']) + ' fps, dropped ' + str(r['dropped']) + ', write':<42} {'':>9} "
+                  f"{fmt(w['p50_ms'])} {fmt(w['p90_ms'])} {fmt(w['p99_ms'])} {fmt(w['max_ms'])}")
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="DeepCool frame pipeline benchmarks (no device required)")
+    parser.add_argument("--iterations", type=int, default=200, help="Iterations per micro benchmark")
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds per end-to-end scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency per USB write in seconds")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Simulated USB bandwidth in bytes/s (0 = unlimited)")
+    parser.add_argument("--video-size", default="1920x1080", help="Synthetic video resolution")
+    parser.add_argument("--decoder", choices=["auto", "ffmpeg", "opencv"], default="opencv")
+    parser.add_argument("--only", choices=["micro", "pipeline"], help="Run only one group")
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    check_encoders()
+    video, image = make_media(tuple(int(v) for v in args.video_size.split("x")), 90)
+    results = {"python": sys.version.split()[0], "latency": args.latency, "bandwidth": args.bandwidth}
+    if args.only != "pipeline":
+        results["micro"] = micro_benchmarks(args.iterations, image)
+        print_table("Micro benchmarks", results["micro"])
+    if args.only != "micro":
+        results["pipeline"] = pipeline_benchmarks(args.duration, args, video, image)
+        print_table(f"End-to-end (mock endpoint, latency {args.latency * 1000:g} ms/write)", results["pipeline"])
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    try: main_bench()
+    finally: shutil.rmtree(TMP_DIR, ignore_errors=True)
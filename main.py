@@ -1,46 +1,150 @@
-import usb.core
-import usb.util
+import importlib.util
 import time
 import struct
-import psutil
 import socket
+import selectors
 import os
 import sys
 import json
 import threading
 import argparse
-import cv2
 import atexit
 import hashlib
+import mmap
+import stat
+import signal
+import random
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
 from collections import deque
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+
+def _lazy_import(name):
+    # 首次访问属性时才真正导入。客户端命令（--media / --brightness 等）只发几个字节，
+    # 不应为 cv2 / numpy / PIL / usb 付出上百毫秒的导入时间；转码子进程同样按需导入
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# usb 包的 __init__ 会一并导入 usb.core 和 usb.util
+usb = _lazy_import("usb")
+psutil = _lazy_import("psutil")
+cv2 = _lazy_import("cv2")
+np = _lazy_import("numpy")
+Image = _lazy_import("PIL.Image")
+ImageDraw = _lazy_import("PIL.ImageDraw")
+ImageFont = _lazy_import("PIL.ImageFont")
+ImageSequence = _lazy_import("PIL.ImageSequence")
+futures = _lazy_import("concurrent.futures")
 
 # --- 全局配置 ---
 SOCKET_PATH = "/tmp/deepcool.sock"
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json")
-CONFIG_LOCK = threading.Lock()
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frame_cache")
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+ANIM_BUDGET_BYTES = 64 << 20
+RAM_CACHE_BYTES = 128 << 20
+FRAME_BYTES = 320 * 240 * 2
 
 # --- 核心工具函数 ---
-def load_settings():
-    with CONFIG_LOCK:
-        if not os.path.exists(CONFIG_FILE): return {}
+class SettingsStore:
+    # 设置常驻内存：update 只改内存并唤醒后台线程，短时间内的多次更新合并成一次落盘；
+    # 落盘方式为 写临时文件 -> fsync -> rename，断电时不会留下写了一半的文件。
+    # fsync 策略（settings.json 中的 settings_fsync）："always" 同时 fsync 文件和目录，
+    # "file" 只 fsync 文件，"never" 完全交给页缓存
+    def __init__(self, path, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.data = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.io_lock = threading.Lock()
+        self.thread = None
+
+    def _ensure_loaded(self):
+        if self.data is not None: return
         try:
-            with open(CONFIG_FILE, 'r') as f: return json.load(f)
-        except: return {}
+            with open(self.path, 'r') as f: self.data = json.load(f)
+        except (OSError, ValueError): self.data = {}
+        if not isinstance(self.data, dict): self.data = {}
+
+    def get_all(self):
+        with self.lock:
+            self._ensure_loaded()
+            return dict(self.data)
+
+    def update(self, updates):
+        with self.lock:
+            self._ensure_loaded()
+            self.data.update(updates)
+            self._mark_dirty()
+
+    def update_section(self, section, key, updates):
+        # 更新 data[section][key] 这一层字典；updates 为 None 时删除该项
+        with self.lock:
+            self._ensure_loaded()
+            table = dict(self.data.get(section) or {})
+            if updates is None: table.pop(key, None)
+            else: table[key] = {**table.get(key, {}), **updates}
+            self.data[section] = table
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        self.dirty = True
+        if not self.thread:
+            self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self.thread.start()
+        self.cond.notify()
+
+    def _writer_loop(self):
+        while True:
+            with self.lock: self.cond.wait_for(lambda: self.dirty)
+            time.sleep(self.delay)  # 合并窗口
+            self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                if not self.dirty: return
+                data, self.dirty = dict(self.data), False
+            try: self._write(data)
+            except OSError as e:
+                print(f"Settings save failed: {e}")
+                with self.lock: self.dirty = True
+
+    def _write(self, data):
+        policy = data.get("settings_fsync", "always")
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            if policy != "never": os.fsync(f.fileno())
+        try: os.chmod(tmp, 0o666)
+        except OSError: pass
+        os.replace(tmp, self.path)
+        if policy == "always":
+            dfd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+            try: os.fsync(dfd)
+            finally: os.close(dfd)
+
+SETTINGS = SettingsStore(CONFIG_FILE)
+atexit.register(SETTINGS.flush)
+
+def load_settings():
+    return SETTINGS.get_all()
 
 def update_settings(updates):
-    with CONFIG_LOCK:
-        current_data = {}
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r') as f: current_data = json.load(f)
-            except: pass
-        current_data.update(updates)
-        try:
-            with open(CONFIG_FILE, 'w') as f: json.dump(current_data, f, indent=2)
-            try: os.chmod(CONFIG_FILE, 0o666)
-            except: pass
-        except: pass
+    SETTINGS.update(updates)
 
 def get_boot_id():
     try:
@@ -69,33 +173,650 @@ def resize_contain(pil_img, target_width=320, target_height=240, bg_color=(0, 0,
     new_img.paste(img_resized, ((target_width - new_width) // 2, (target_height - new_height) // 2))
     return new_img
 
-def process_frame_cv2(cv_frame, target_width=320, target_height=240, mode='contain'):
+def fit_frame_cv2(cv_frame, target_width=320, target_height=240, mode='contain'):
+    # 直接在 BGR ndarray 上完成缩放 + 居中/裁剪，不经过 PIL
     h, w = cv_frame.shape[:2]
     scale = min(target_width / w, target_height / h) if mode == 'contain' else max(target_width / w, target_height / h)
     new_w, new_h = int(w * scale), int(h * scale)
     resized = cv2.resize(cv_frame, (new_w, new_h), interpolation=cv2.INTER_AREA)
-    rgb_frame = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
-    pil_content = Image.fromarray(rgb_frame)
+    if (new_w, new_h) == (target_width, target_height): return resized
+    canvas = np.zeros((target_height, target_width, 3), dtype=np.uint8)
     if mode == 'cover':
-        left = (new_w - target_width) // 2
-        top = (new_h - target_height) // 2
-        return pil_content.crop((left, top, left + target_width, top + target_height))
+        left, top = (new_w - target_width) // 2, (new_h - target_height) // 2
+        src = resized[max(top, 0):top + target_height, max(left, 0):left + target_width]
+        dx, dy = max(-left, 0), max(-top, 0)
     else:
-        new_img = Image.new("RGB", (target_width, target_height), (0, 0, 0))
-        new_img.paste(pil_content, ((target_width - new_w) // 2, (target_height - new_h) // 2))
-        return new_img
+        src = resized
+        dx, dy = (target_width - new_w) // 2, (target_height - new_h) // 2
+    canvas[dy:dy + src.shape[0], dx:dx + src.shape[1]] = src
+    return canvas
+
+def process_frame_cv2(cv_frame, target_width=320, target_height=240, mode='contain'):
+    fitted = fit_frame_cv2(cv_frame, target_width, target_height, mode)
+    return Image.fromarray(cv2.cvtColor(fitted, cv2.COLOR_BGR2RGB))
+
+# --- RGB565 编码 ---
+def pack_rgb565(frame, bgr=False):
+    # frame: HxWx3 uint8 (RGB, 或 bgr=True 时为 OpenCV 的 BGR)，返回 HxW 的小端 uint16 数组
+    arr = np.asarray(frame, dtype=np.uint8)
+    r, g, b = (arr[..., 2], arr[..., 1], arr[..., 0]) if bgr else (arr[..., 0], arr[..., 1], arr[..., 2])
+    out = (r.astype(np.uint16) & 0xF8) << 8
+    out |= (g.astype(np.uint16) & 0xFC) << 3
+    out |= b >> 3
+    return out.astype('<u2', copy=False)
+
+def encode_rgb565(frame, bgr=False):
+    return pack_rgb565(frame, bgr).tobytes()
+
+def encode_rgb565_reference(img):
+    # 原始逐像素实现，仅用于校验 encode_rgb565 的输出（bench.py 开始计时前逐字节比对）
+    buffer = bytearray(img.width * img.height * 2)
+    idx = 0
+    for r, g, b in img.getdata():
+        r5, g6, b5 = (r >> 3) & 0x1F, (g >> 2) & 0x3F, (b >> 3) & 0x1F
+        struct.pack_into('<H', buffer, idx, (r5 << 11) | (g6 << 5) | b5)
+        idx += 2
+    return buffer
+
+class Rgb565Encoder:
+    # 亮度做成按通道的查找表，直接融合进 RGB565 编码；只在亮度变化时重建
+    def __init__(self, level=1.0):
+        self.set_level(level)
+
+    def set_level(self, level):
+        level = max(0.0, min(1.0, float(level)))
+        v = np.minimum(np.arange(256) * level + 0.5, 255).astype(np.uint16)
+        lut_r, lut_g, lut_b = (v & 0xF8) << 8, (v & 0xFC) << 3, v >> 3
+        # 已编码帧用的 65536 项表：565 -> 展开到 8bit -> 同一套通道表
+        px = np.arange(65536, dtype=np.uint16)
+        r5, g6, b5 = px >> 11, (px >> 5) & 0x3F, px & 0x1F
+        lut565 = lut_r[(r5 << 3) | (r5 >> 2)] | lut_g[(g6 << 2) | (g6 >> 4)] | lut_b[(b5 << 3) | (b5 >> 2)]
+        self._tables = (lut_r, lut_g, lut_b, lut565.astype('<u2'))
+        self.level = level
+
+    def pack(self, frame, bgr=False):
+        if self.level >= 1.0: return pack_rgb565(frame, bgr)
+        lut_r, lut_g, lut_b, _ = self._tables
+        arr = np.asarray(frame, dtype=np.uint8)
+        r, g, b = (arr[..., 2], arr[..., 1], arr[..., 0]) if bgr else (arr[..., 0], arr[..., 1], arr[..., 2])
+        out = lut_r[r]
+        out |= lut_g[g]
+        out |= lut_b[b]
+        return out.astype('<u2', copy=False)
+
+    def encode(self, frame, bgr=False):
+        return self.pack(frame, bgr).tobytes()
+
+    def apply(self, buffer):
+        # 对已编码的 RGB565 帧（缓存帧）应用亮度
+        if self.level >= 1.0: return buffer
+        return self._tables[3][np.frombuffer(buffer, dtype='<u2')].tobytes()
+
+# --- ffmpeg 解码 ---
+FFMPEG_FILTERS = {
+    # 缩放、居中/裁剪都在 ffmpeg 里完成，输出直接是屏幕要的小端 RGB565。
+    # 画面与 OpenCV 路径视觉上一致但不逐字节相同：缩放取整不同（如 427 与 426 像素宽），边缘和颜色会有几级差异。
+    # 后台转码的帧缓存仍由 OpenCV 生成，播放中从 ffmpeg 切到缓存时可能有轻微变化
+    'contain': "scale={w}:{h}:force_original_aspect_ratio=decrease:flags=area,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2:black",
+    'cover': "scale={w}:{h}:force_original_aspect_ratio=increase:flags=area,crop={w}:{h}",
+}
+
+def ffmpeg_path():
+    return shutil.which("ffmpeg")
+
+class FFmpegVideo:
+    # ffmpeg 子进程解码：管道里读出的已经是 320x240 rgb565le，直接 readinto 到复用的缓冲区。
+    # 对外提供和 cv2.VideoCapture 相同的一小部分接口（read / grab / get / set / isOpened / release）
+    def __init__(self, path, fps, fit='contain', width=320, height=240):
+        self.path, self.fps = path, fps
+        self.vf = FFMPEG_FILTERS.get(fit, FFMPEG_FILTERS['contain']).format(w=width, h=height)
+        self.frame_bytes = width * height * 2
+        self.buf = bytearray(self.frame_bytes)
+        self._view = memoryview(self.buf)
+        self.proc = None
+        self.pos = 0
+        self._pending = False
+        self._start(0)
+        # 先读出第一帧确认能解码，失败时由调用方回退到 OpenCV
+        if not self._fill():
+            self._stop()
+            raise ValueError(f"ffmpeg cannot decode {path}")
+        self._pending = True
+
+    def _start(self, index):
+        self._stop()
+        cmd = [ffmpeg_path() or "ffmpeg", "-v", "error", "-nostdin"]
+        if index: cmd += ["-ss", f"{index / self.fps:.3f}"]
+        cmd += ["-i", self.path, "-an", "-sn", "-vf", self.vf, "-pix_fmt", "rgb565le", "-f", "rawvideo", "pipe:1"]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=0)
+        self.pos = index
+        self._pending = False
+
+    def _stop(self):
+        proc, self.proc = self.proc, None
+        if not proc: return
+        if proc.poll() is None: proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+    def _fill(self):
+        # 读满一帧；到结尾或进程退出时返回 False
+        view, got = self._view, 0
+        while got < self.frame_bytes:
+            n = self.proc.stdout.readinto(view[got:])
+            if not n: return False
+            got += n
+        return True
+
+    def read_frame(self):
+        # 返回复用缓冲区的视图（下次读取会被覆盖），到结尾返回 None
+        if not self.proc: return None
+        if self._pending: self._pending = False
+        elif not self._fill(): return None
+        self.pos += 1
+        return self._view
+
+    def read(self):
+        frame = self.read_frame()
+        return frame is not None, frame
+
+    def grab(self):
+        return self.read_frame() is not None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES: return self.pos
+        if prop == cv2.CAP_PROP_FPS: return self.fps
+        return 0
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES: return False
+        self._start(int(value))
+        return True
+
+    def isOpened(self):
+        return self.proc is not None
+
+    def release(self):
+        self._stop()
+
+# --- 预转码帧缓存 ---
+def _transcode_chunk(path, out_path, start, count, mode):
+    # 进程池 worker：解码 [start, start+count) 帧并写入缓存文件对应偏移
+    cap = cv2.VideoCapture(path)
+    if start: cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    done = 0
+    with open(out_path, 'r+b') as f:
+        f.seek(start * FRAME_BYTES)
+        while count < 0 or done < count:
+            ret, frame = cap.read()
+            if not ret: break
+            f.write(encode_rgb565(fit_frame_cv2(frame, 320, 240, mode), bgr=True))
+            done += 1
+    cap.release()
+    return done
+
+class CachedVideo:
+    # mmap 回放：每帧就是文件中一段现成的 RGB565 数据
+    def __init__(self, data_path, fps, frame_count):
+        self.fps = fps
+        self.frame_count = frame_count
+        self.pos = 0
+        self._file = open(data_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try: self._map.madvise(mmap.MADV_SEQUENTIAL)
+        except (AttributeError, OSError): pass
+        self._view = memoryview(self._map)
+
+    def seek(self, index):
+        self.pos = index % self.frame_count
+
+    def read(self):
+        if self.pos >= self.frame_count: self.pos = 0
+        off = self.pos * FRAME_BYTES
+        self.pos += 1
+        return self._view[off:off + FRAME_BYTES]
+
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError: pass  # 仍有帧切片在用，交给 GC 回收映射
+        self._file.close()
+
+class FrameStore:
+    # 短视频的内存帧库：一块预分配的 N x 153600 字节连续内存。
+    # 第一轮边播边解码边存入，之后的循环完全从内存播放，不再 seek / 解码
+    def __init__(self, capacity):
+        self.data = bytearray(capacity * FRAME_BYTES)
+        self.capacity = capacity
+        self.filled = 0
+        self.complete = False
+        self.pos = 0
+        self._view = memoryview(self.data)
+
+    def append(self, frame):
+        if self.complete: return True
+        if self.filled >= self.capacity: return False
+        off = self.filled * FRAME_BYTES
+        self._view[off:off + FRAME_BYTES] = frame
+        self.filled += 1
+        return True
+
+    def fill_from(self, source):
+        # 从已完成的磁盘缓存整体拷贝
+        if source.frame_count > self.capacity: return False
+        n = source.frame_count * FRAME_BYTES
+        self._view[:n] = source._view[:n]
+        self.filled = source.frame_count
+        return self.finish()
+
+    def finish(self):
+        if not self.filled: return False
+        self.complete = True
+        self.frame_count = self.filled
+        return True
+
+    def seek(self, index):
+        self.pos = index % self.frame_count
+
+    def read(self):
+        if self.pos >= self.frame_count: self.pos = 0
+        off = self.pos * FRAME_BYTES
+        self.pos += 1
+        return self._view[off:off + FRAME_BYTES]
+
+class FrameCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, workers=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        self.active = {}  # 正在转码的 key -> 临时文件路径，同一文件同时只转一份
+        self.pools = set()
+        self.closing = False
+        # 退出时终止转码进程并删掉临时文件，不让进程池拖住退出（systemd 超时后会 SIGKILL，留下孤儿临时文件）
+        atexit.register(self.close)
+
+    def _key(self, path, mode):
+        st = os.stat(path)
+        raw = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{mode}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".rgb565", base + ".json"
+
+    def lookup(self, path, mode='contain'):
+        try:
+            data_path, meta_path = self._paths(self._key(path, mode))
+            with open(meta_path, 'r') as f: meta = json.load(f)
+            if os.path.getsize(data_path) != meta["frames"] * FRAME_BYTES: return None
+            os.utime(data_path)  # LRU: 命中即刷新 mtime
+            return CachedVideo(data_path, meta["fps"], meta["frames"])
+        except (OSError, ValueError, KeyError): return None
+
+    def transcode(self, path, mode='contain'):
+        cap = cv2.VideoCapture(path)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        if total > 0 and total * FRAME_BYTES > self.max_bytes: return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key = self._key(path, mode)
+        data_path, meta_path = self._paths(key)
+        with self.lock:
+            if self.closing or key in self.active: return None
+            self.active[key] = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=key + ".", suffix=".tmp")
+            with self.lock: self.active[key] = tmp_path
+            with os.fdopen(fd, 'wb') as f:
+                if total > 0: f.truncate(total * FRAME_BYTES)
+        except OSError:
+            with self.lock: self.active.pop(key, None)
+            raise
+        try:
+            if total > 0:
+                # 按帧区间切块，分给进程池并行解码
+                n = min(self.workers, max(1, total // 60))
+                step = -(-total // n)
+                ranges = [(s, min(step, total - s)) for s in range(0, total, step)]
+                pool = multiprocessing.get_context("spawn").Pool(n)
+                with self.lock:
+                    if self.closing:
+                        pool.terminate()
+                        raise RuntimeError("shutting down")
+                    self.pools.add(pool)
+                try: counts = pool.starmap(_transcode_chunk, [(path, tmp_path, s, c, mode) for s, c in ranges])
+                finally:
+                    with self.lock: self.pools.discard(pool)
+                    pool.terminate()
+                # 帧数元数据不准时，只保留连续有效的前缀
+                frames = 0
+                for (s, c), done in zip(ranges, counts):
+                    frames += done
+                    if done < c: break
+            else:
+                frames = _transcode_chunk(path, tmp_path, 0, -1, mode)
+            if frames == 0: raise ValueError("no frames decoded")
+            with open(tmp_path, 'r+b') as f: f.truncate(frames * FRAME_BYTES)
+            os.replace(tmp_path, data_path)
+            with open(meta_path, 'w') as f:
+                json.dump({"path": os.path.abspath(path), "mode": mode, "fps": fps if fps > 0 else 30.0, "frames": frames}, f)
+        except Exception:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+        finally:
+            with self.lock: self.active.pop(key, None)
+        self.evict(keep=key)
+        return self.lookup(path, mode)
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            pools, tmp_paths = list(self.pools), [p for p in self.active.values() if p]
+        for pool in pools: pool.terminate()
+        for p in tmp_paths:
+            try: os.unlink(p)
+            except OSError: pass
+
+    def evict(self, keep=None):
+        # 按 mtime 做 LRU，超出上限时从最久未用的开始删除；
+        # 顺带清理被中断的转码留下的临时文件（预分配为整段大小）
+        with self.lock:
+            entries, total = [], 0
+            try: names = os.listdir(self.cache_dir)
+            except OSError: return
+            for name in names:
+                if name.endswith(".tmp") and name.split(".", 1)[0] not in self.active:
+                    try: os.unlink(os.path.join(self.cache_dir, name))
+                    except OSError: pass
+                    continue
+                if not name.endswith(".rgb565"): continue
+                try: st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError: continue
+                entries.append((st.st_mtime, st.st_size, name[:-len(".rgb565")]))
+                total += st.st_size
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes: break
+                if key == keep: continue
+                for p in self._paths(key):
+                    try: os.unlink(p)
+                    except OSError: pass
+                total -= size
+
+# --- 动图 (GIF / APNG / WebP) ---
+class AnimatedImage:
+    # 所有帧一次性解码并预编码成 RGB565 存在一块连续内存里，按每帧自己的时长在精确时间轴上播放
+    def __init__(self, data, durations):
+        self.data = data
+        self.durations = durations
+        self.ends = list(accumulate(durations))
+        self.total = self.ends[-1]
+        self.frame_count = len(durations)
+        self._view = memoryview(data)
+
+    def frame(self, idx):
+        return self._view[idx * FRAME_BYTES:(idx + 1) * FRAME_BYTES]
+
+    def frame_at(self, t):
+        # 返回 (t 时刻应显示的帧, 距离下一次换帧的秒数)
+        t %= self.total
+        idx = bisect_right(self.ends, t)
+        return idx, self.ends[idx] - t
+
+def load_animation(path, fit='contain', budget=ANIM_BUDGET_BYTES):
+    # 不是多帧图片时返回 None（交给 OpenCV 路径）；超出内存预算时抛 MemoryError
+    try: img = Image.open(path)
+    except OSError: return None
+    with img:
+        if not getattr(img, "is_animated", False) or getattr(img, "n_frames", 1) < 2: return None
+        data, durations, prev = bytearray(), [], None
+        for frame in ImageSequence.Iterator(img):
+            rgba = np.asarray(frame.convert("RGBA"))
+            # 帧数据加载后 info 才是当前帧的（WebP）；与浏览器一致，<=10ms 的帧时长按 100ms 处理
+            duration = frame.info.get("duration") or 0
+            duration = duration / 1000.0 if duration > 10 else 0.1
+            rgb = (rgba[..., :3].astype(np.uint16) * rgba[..., 3:] // 255).astype(np.uint8)  # 透明区域叠在黑底上
+            packed = pack_rgb565(fit_frame_cv2(rgb, 320, 240, fit)).tobytes()
+            if packed == prev:
+                # 连续相同的帧合并，只累加时长
+                durations[-1] += duration
+                continue
+            if len(data) + FRAME_BYTES > budget: raise MemoryError(f"Animation exceeds {budget >> 20} MiB budget")
+            data += packed
+            durations.append(duration)
+            prev = packed
+    return AnimatedImage(data, durations)
+
+# --- 共享内存帧输入 ---
+# 外部程序在 /dev/shm 下创建环形缓冲并通过 socket 注册一次，之后推帧只是写内存，
+# 数据路径上没有 socket / JSON / PNG。布局（小端）：
+#   0  magic "DCFB" | 4 version u16 | 6 format u16 (0=rgb565le, 1=rgb888) | 8 width u16 | 10 height u16 | 12 slots u32
+#   16 write_seq u64：已发布的帧数，最新帧位于槽 (write_seq-1) % slots
+#   24 read_seq u64：服务端最近取走的帧序号
+#   64 起为 slots 个连续帧槽
+# 生产者先写完槽位再更新 write_seq。
+STREAM_MAGIC = b"DCFB"
+STREAM_HEADER = struct.Struct("<4sHHHHI")
+STREAM_HEADER_SIZE = 64
+STREAM_WRITE_SEQ, STREAM_READ_SEQ = 16, 24
+STREAM_FORMATS = {0: ("rgb565", FRAME_BYTES), 1: ("rgb888", 320 * 240 * 3)}
+STREAM_POLL_HZ = 60.0  # 实际上限还会被实测 USB 吞吐压低
+
+class StreamSource:
+    def __init__(self, path):
+        # 服务以 root 运行且 socket 对所有用户开放：只接受 /dev/shm 下的文件名（"<名称>" 或 "/dev/shm/<名称>"），
+        # 相对 /dev/shm 的目录 fd 打开且不跟随符号链接，路径中途被换成链接也打不开 /dev/shm 以外的节点
+        folder, name = os.path.split(path)
+        if folder not in ("", "/dev/shm") or name in ("", ".", ".."): raise ValueError("Stream buffer must be a file directly in /dev/shm")
+        dir_fd = os.open("/dev/shm", os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        try: fd = os.open(name, os.O_RDWR | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+        finally: os.close(dir_fd)
+        try:
+            if not stat.S_ISREG(os.fstat(fd).st_mode): raise ValueError("Stream buffer is not a regular file")
+            self._map = mmap.mmap(fd, 0)
+        finally: os.close(fd)
+        magic, version, fmt, w, h, slots = STREAM_HEADER.unpack_from(self._map, 0)
+        if magic != STREAM_MAGIC or version != 1: raise ValueError("Bad stream header")
+        if fmt not in STREAM_FORMATS or (w, h) != (320, 240) or slots < 2: raise ValueError("Unsupported stream layout")
+        self.path = path
+        self.format, self.frame_size = STREAM_FORMATS[fmt]
+        self.slots = slots
+        if len(self._map) < STREAM_HEADER_SIZE + slots * self.frame_size: raise ValueError("Stream buffer too small")
+        self._view = memoryview(self._map)
+        self.last_seq = 0
+        self.frames = 0
+        self.torn = 0
+
+    def _write_seq(self):
+        return struct.unpack_from("<Q", self._map, STREAM_WRITE_SEQ)[0]
+
+    def rewind(self):
+        # 重新推送当前最新帧（例如设备重连后）
+        self.last_seq = 0
+
+    def read(self, encoder):
+        # 有新帧时返回编码好的 RGB565 数据，否则返回 None
+        seq = self._write_seq()
+        if seq == self.last_seq or seq == 0: return None
+        off = STREAM_HEADER_SIZE + ((seq - 1) % self.slots) * self.frame_size
+        view = self._view[off:off + self.frame_size]
+        try:
+            if self.format == "rgb565": buf = bytes(encoder.apply(view))  # 唯一一次内存拷贝（pyusb 需要自有缓冲区）
+            else: buf = encoder.encode(np.frombuffer(view, dtype=np.uint8).reshape(240, 320, 3))
+        finally: view.release()
+        # 读取期间生产者已绕环一圈，这一帧可能被覆盖，丢弃
+        if self._write_seq() - seq >= self.slots - 1:
+            self.torn += 1
+            return None
+        self.last_seq = seq
+        struct.pack_into("<Q", self._map, STREAM_READ_SEQ, seq)
+        self.frames += 1
+        return buf
+
+    def snapshot(self):
+        return {"path": self.path, "format": self.format, "slots": self.slots, "frames": self.frames, "torn": self.torn}
+
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError: pass
+
+# --- 传感器发现 ---
+HWMON_ROOT = "/sys/class/hwmon"
+POWERCAP_ROOT = "/sys/class/powercap"
+
+class SysfsValue:
+    # 常驻打开的 sysfs 文件，每次用 pread 从偏移 0 重读，省去 open/close
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        return int(os.pread(self.fd, 32, 0))
+
+    def close(self):
+        try: os.close(self.fd)
+        except OSError: pass
+
+def _read_text(path):
+    try:
+        with open(path, 'r') as f: return f.read().strip()
+    except OSError: return ""
+
+def _hwmon_devices():
+    # [(name, dir)]，按 hwmon 编号排序
+    try: entries = os.listdir(HWMON_ROOT)
+    except OSError: return []
+    devices = []
+    for entry in sorted(entries, key=lambda e: int(e[5:]) if e[5:].isdigit() else 0):
+        d = os.path.join(HWMON_ROOT, entry)
+        devices.append((_read_text(os.path.join(d, "name")), d))
+    return devices
+
+def _hwmon_inputs(d, kind):
+    # 返回 [(序号, label, 路径)]，如 temp1_input / power2_input
+    try: names = os.listdir(d)
+    except OSError: return []
+    found = []
+    for n in names:
+        if n.startswith(kind) and n.endswith("_input") and n[len(kind):-6].isdigit():
+            idx = int(n[len(kind):-6])
+            found.append((idx, _read_text(os.path.join(d, f"{kind}{idx}_label")), os.path.join(d, n)))
+    return sorted(found)
+
+def resolve_temp_sensors():
+    # 优先级与原 psutil 逻辑一致：k10temp(Tctl/Tdie) > coretemp(Package) > acpitz > zenpower
+    devices = _hwmon_devices()
+    by_name = {}
+    for name, d in devices: by_name.setdefault(name, []).append(d)
+    for d in by_name.get("k10temp", []):
+        for _, label, path in _hwmon_inputs(d, "temp"):
+            if label in ("Tctl", "Tdie"): return [path]
+    # 多路 Intel CPU 每个 package 一个 coretemp，取最大值
+    pkgs = [path for d in by_name.get("coretemp", []) for _, label, path in _hwmon_inputs(d, "temp") if label.startswith("Package id")]
+    if pkgs: return pkgs
+    for name in ("acpitz", "zenpower"):
+        for d in by_name.get(name, []):
+            inputs = _hwmon_inputs(d, "temp")
+            if inputs: return [inputs[0][2]]
+    return []
+
+def resolve_power_sensors():
+    # 返回 ("rapl", [(energy_uj 路径, max_energy_range_uj)]) 或 ("hwmon", [power*_input 路径])
+    packages = []
+    try: entries = os.listdir(POWERCAP_ROOT)
+    except OSError: entries = []
+    for entry in sorted(entries):
+        # 只取顶层 package 域 (intel-rapl:N)，子域 core/uncore/dram 已包含在内
+        if not entry.startswith("intel-rapl:") or entry.count(":") != 1: continue
+        d = os.path.join(POWERCAP_ROOT, entry)
+        path = os.path.join(d, "energy_uj")
+        if not _read_text(os.path.join(d, "name")).startswith("package") or not os.access(path, os.R_OK): continue
+        try: max_range = int(_read_text(os.path.join(d, "max_energy_range_uj")))
+        except ValueError: max_range = 0
+        packages.append((path, max_range))
+    if packages: return "rapl", packages
+    for name, d in _hwmon_devices():
+        if name in ("zenpower", "fam15h_power"):
+            inputs = [path for _, _, path in _hwmon_inputs(d, "power")]
+            if inputs: return "hwmon", inputs
+    return None, []
+
+# --- 指标历史 ---
+class MetricRing:
+    # 定长环形缓冲，底层是 array('f')，容量固定、内存固定
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = array('f', bytes(4 * capacity))
+        self.head = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity: self.count += 1
+
+    def latest(self, default=0.0):
+        return self.data[self.head - 1] if self.count else default
+
+    def last(self, n):
+        # 最近 n 个值，旧 -> 新
+        n = min(n, self.count)
+        start = (self.head - n) % self.capacity
+        if start + n <= self.capacity: return self.data[start:start + n].tolist()
+        return (self.data[start:] + self.data[:self.head]).tolist()
+
+class MetricHistory:
+    # 多分辨率历史：原始采样层 + 逐级取均值的 1s / 1m / 1h 层
+    TIERS = (("1s", 3600), ("1m", 1440), ("1h", 720))
+
+    def __init__(self, sample_hz, raw_seconds=60):
+        self.raw = MetricRing(int(sample_hz * raw_seconds))
+        self.tiers = {name: MetricRing(cap) for name, cap in self.TIERS}
+        # (层, 每个点由下一级多少个点取均值, 累加器)
+        spans = (max(1, round(sample_hz)), 60, 60)
+        self._levels = [(self.tiers[name], span, [0.0, 0]) for (name, _), span in zip(self.TIERS, spans)]
+
+    def add(self, value):
+        self.raw.append(value)
+        for ring, span, acc in self._levels:
+            acc[0] += value
+            acc[1] += 1
+            if acc[1] < span: return
+            value = acc[0] / span
+            ring.append(value)
+            acc[0], acc[1] = 0.0, 0
+
+    def get(self, tier="raw", count=60):
+        ring = self.raw if tier == "raw" else self.tiers[tier]
+        return ring.last(count)
 
 # --- 硬件监控类 ---
 class SystemMonitor:
+    RESCAN_INTERVAL = 30.0
+    SAMPLE_HZ = 5.0
+    GRAPH_POINTS = 60
+
     def __init__(self):
         self.hostname = socket.gethostname()
-        self.usage_history = deque([0] * 60, maxlen=60)
-        self.power_path = None
-        self.last_rapl_energy = 0
+        self.history = {name: MetricHistory(self.SAMPLE_HZ) for name in ("usage", "temp", "power")}
+        self.history_lock = threading.Lock()
+        self.sampler = None
+        self.temp_sensors = []
+        self.power_kind = None
+        self.power_sensors = []
+        self.power_ranges = []
+        self.last_rapl_energy = []
         self.last_rapl_time = 0
         self.last_valid_power = 0.0
         self.stuck_counter = 0
         self.last_save_time = time.time()
+        self.hwmon_entries = None
+        self.next_rescan = 0.0
 
         settings = load_settings()
         saved_total = settings.get("total_seconds", 0)
@@ -109,34 +830,52 @@ class SystemMonitor:
             self.history_base = saved_total
             update_settings({"boot_id": current_boot_id})
 
+        self._init_temp_monitoring()
         self._init_power_monitoring()
         atexit.register(self.force_save_runtime)
 
+    def _check_hotplug(self):
+        # 定期比对 hwmon 目录项，有变化（热插拔、驱动加载）就重新解析传感器
+        now = time.monotonic()
+        if now < self.next_rescan: return
+        # 还没有找到温度传感器时（驱动可能尚未加载）每秒检查一次
+        self.next_rescan = now + (self.RESCAN_INTERVAL if self.temp_sensors else 1.0)
+        try: entries = sorted(os.listdir(HWMON_ROOT))
+        except OSError: entries = []
+        if self.hwmon_entries is not None and entries != self.hwmon_entries:
+            print("Sensor change detected, rescanning...")
+            self._init_temp_monitoring()
+            self._init_power_monitoring()
+        elif self.hwmon_entries is not None and not self.power_kind:
+            self._init_power_monitoring()
+        self.hwmon_entries = entries
+
+    def _init_temp_monitoring(self):
+        for s in self.temp_sensors: s.close()
+        self.temp_sensors = []
+        for path in resolve_temp_sensors():
+            try: self.temp_sensors.append(SysfsValue(path))
+            except OSError: continue
+        if self.temp_sensors: print(f"Temp sensor linked: {', '.join(s.path for s in self.temp_sensors)}")
+
     def _init_power_monitoring(self):
-        self.power_path = None
-        candidates = [
-            '/sys/class/powercap/intel-rapl:0/energy_uj',
-            '/sys/class/hwmon/hwmon0/power1_input',
-            '/sys/class/hwmon/hwmon1/power1_input',
-            '/sys/class/hwmon/hwmon2/power1_input',
-            '/sys/class/hwmon/hwmon3/power1_input'
-        ]
-        for path in candidates:
-            if os.path.exists(path) and os.access(path, os.R_OK):
-                try:
-                    with open(path, 'r') as f: _ = int(f.read().strip())
-                    self.power_path = path
-                    print(f"Power sensor linked: {path}")
-                    break
-                except: continue
-        if self.power_path:
+        for s in self.power_sensors: s.close()
+        self.power_sensors = []
+        kind, found = resolve_power_sensors()
+        paths = [p for p, _ in found] if kind == "rapl" else found
+        try: self.power_sensors = [SysfsValue(p) for p in paths]
+        except OSError:
+            for s in self.power_sensors: s.close()
+            self.power_sensors, kind = [], None
+        self.power_kind = kind if self.power_sensors else None
+        self.power_ranges = [r for _, r in found] if kind == "rapl" else []
+        if self.power_kind:
+            print(f"Power sensor linked: {', '.join(s.path for s in self.power_sensors)}")
+        if self.power_kind == "rapl":
             try:
-                self.last_rapl_energy = int(self._read_file(self.power_path))
-                self.last_rapl_time = time.time()
-            except: pass
-
-    def _read_file(self, path):
-        with open(path, 'r') as f: return f.read().strip()
+                self.last_rapl_energy = [s.read() for s in self.power_sensors]
+                self.last_rapl_time = time.monotonic()
+            except (OSError, ValueError): pass
 
     def force_save_runtime(self):
         current_total = self.history_base + get_raw_uptime()
@@ -160,36 +899,78 @@ class SystemMonitor:
         if d > 0: return f"UP: {int(d)}d {int(h):02}:{int(m):02}:{int(s):02}"
         return f"UP: {int(h):02}:{int(m):02}:{int(s):02}"
 
+    # --- 后台定频采样：图表时间轴与渲染帧率无关，RAPL 功率按固定间隔求差 ---
+    def start_sampler(self):
+        if self.sampler: return
+        self.sampler = threading.Thread(target=self._sampler_loop, daemon=True)
+        self.sampler.start()
+
+    def _sampler_loop(self):
+        interval = 1.0 / self.SAMPLE_HZ
+        deadline = time.monotonic()
+        while True:
+            try: self.sample()
+            except Exception as e: print(f"Sampler error: {e}")
+            deadline += interval
+            wait = deadline - time.monotonic()
+            if wait > 0: time.sleep(wait)
+            else: deadline = time.monotonic()
+
+    def sample(self):
+        usage, temp, power = self._read_cpu_usage(), self._read_cpu_temp(), self._read_cpu_power()
+        with self.history_lock:
+            self.history["usage"].add(usage)
+            self.history["temp"].add(temp)
+            self.history["power"].add(power)
+
+    def get_history(self, metric, tier="raw", count=60):
+        with self.history_lock: return self.history[metric].get(tier, count)
+
+    @property
+    def usage_history(self):
+        # 图表用最近 GRAPH_POINTS 个原始采样，不足时前面补 0
+        values = self.get_history("usage", "raw", self.GRAPH_POINTS)
+        return [0.0] * (self.GRAPH_POINTS - len(values)) + values
+
     def get_cpu_usage(self):
-        usage = psutil.cpu_percent(interval=0)
-        self.usage_history.append(usage)
-        return usage
+        return self.history["usage"].raw.latest()
 
     def get_cpu_temp(self):
-        temps = psutil.sensors_temperatures()
-        if 'k10temp' in temps:
-            for entry in temps['k10temp']:
-                if entry.label in ['Tctl', 'Tdie']: return entry.current
-        sensor_names = ['acpitz', 'zenpower']
-        for name in sensor_names:
-            if name in temps: return temps[name][0].current
-        return 0.0
+        return self.history["temp"].raw.latest()
 
     def get_cpu_power(self):
-        if not self.power_path:
-            self._init_power_monitoring()
-            if not self.power_path: return 0.0
+        return self.history["power"].raw.latest()
+
+    def _read_cpu_usage(self):
+        return psutil.cpu_percent(interval=0)
+
+    def _read_cpu_temp(self):
+        self._check_hotplug()
+        if not self.temp_sensors: return 0.0
+        try: return max(s.read() for s in self.temp_sensors) / 1000.0
+        except (OSError, ValueError):
+            self._init_temp_monitoring()
+            return 0.0
+
+    def _read_cpu_power(self):
+        # 没找到传感器时不再每帧重扫，交给 _check_hotplug 定期处理
+        if not self.power_kind: return 0.0
         try:
-            raw_val = int(self._read_file(self.power_path))
-            current_time = time.time()
+            if self.power_kind == "hwmon":
+                # hwmon 的 power*_input 是瞬时功率 (µW)
+                self.last_valid_power = sum(s.read() for s in self.power_sensors) / 1_000_000.0
+                return self.last_valid_power
+
+            raw_vals = [s.read() for s in self.power_sensors]
+            current_time = time.monotonic()
             time_delta = current_time - self.last_rapl_time
             if time_delta < 0.01: return self.last_valid_power
-            energy_delta = raw_val - self.last_rapl_energy
-
-            if energy_delta < 0:
-                self.last_rapl_energy = raw_val
-                self.last_rapl_time = current_time
-                return self.last_valid_power
+            energy_delta = 0
+            for raw, last, max_range in zip(raw_vals, self.last_rapl_energy, self.power_ranges):
+                d = raw - last
+                # 计数器回绕
+                if d < 0: d = d + max_range if max_range else 0
+                energy_delta += d
 
             if energy_delta == 0:
                 self.stuck_counter += 1
@@ -201,13 +982,11 @@ class SystemMonitor:
 
             self.stuck_counter = 0
             watts = (energy_delta / 1_000_000.0) / time_delta
-            if watts == 0.0 and self.last_valid_power > 1.0: return self.last_valid_power
-
             self.last_valid_power = watts
-            self.last_rapl_energy = raw_val
+            self.last_rapl_energy = raw_vals
             self.last_rapl_time = current_time
             return watts
-        except:
+        except (OSError, ValueError):
             self.stuck_counter += 1
             if self.stuck_counter > 10:
                 self._init_power_monitoring()
@@ -215,20 +994,156 @@ class SystemMonitor:
             return self.last_valid_power
 
 # --- 屏幕驱动类 ---
+# 可替换的显示后端：和 pyusb 的 OUT 端点同样提供 write(data, timeout)，没有实体设备时用于测试和基准。
+# 一帧 = 帧头 PACKET_HEADER + 153600 字节像素数据（可能被分块写入）
+class NullEndpoint:
+    # 丢弃所有数据，只计数
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.frames = 0
+        self.pending = None  # 当前帧已收到的像素字节数；不在帧内时为 None
+
+    def write(self, data, timeout=None):
+        n = len(data)
+        self.writes += 1
+        self.bytes += n
+        if n == len(DeepCoolScreen.PACKET_HEADER) and data == DeepCoolScreen.PACKET_HEADER:
+            self.pending = 0
+        elif self.pending is not None:
+            self._on_payload(data)
+            self.pending += n
+            if self.pending >= FRAME_BYTES:
+                self.pending = None
+                self.frames += 1
+                self._on_frame()
+        return n
+
+    def _on_payload(self, data): pass
+
+    def _on_frame(self): pass
+
+    def clear_halt(self, ep): pass
+
+    def snapshot(self):
+        return {"writes": self.writes, "bytes": self.bytes, "frames": self.frames}
+
+class MockEndpoint(NullEndpoint):
+    # 模拟 USB 端点：记录写入，可注入传输延迟（固定延迟 + 按带宽计算）和随机错误
+    def __init__(self, latency=0.0, bandwidth=0.0, error_rate=0.0, keep=64, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.bandwidth = bandwidth  # 字节/秒，0 表示不限
+        self.error_rate = error_rate
+        self.errors = 0
+        self.log = deque(maxlen=keep)  # (monotonic 时间, 长度)
+        self.frame = bytearray()
+        self.last_frame = None
+        self.rng = random.Random(seed)
+
+    def write(self, data, timeout=None):
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise usb.core.USBError("Injected transfer error")
+        delay = self.latency + (len(data) / self.bandwidth if self.bandwidth else 0.0)
+        if delay: time.sleep(delay)
+        self.log.append((time.monotonic(), len(data)))
+        return super().write(data, timeout)
+
+    def _on_payload(self, data):
+        if self.pending == 0: self.frame = bytearray()
+        self.frame += data
+
+    def _on_frame(self):
+        self.last_frame = bytes(self.frame)
+
+    def snapshot(self):
+        res = super().snapshot()
+        res["errors"] = self.errors
+        return res
+
+class FileEndpoint(NullEndpoint):
+    # 把像素数据追加写入文件（320x240 rgb565le 裸流），可用
+    # ffplay -f rawvideo -pixel_format rgb565le -video_size 320x240 <文件> 回看
+    def __init__(self, path):
+        super().__init__()
+        self.f = open(path, 'wb')
+
+    def _on_payload(self, data):
+        self.f.write(data)
+
+    def _on_frame(self):
+        self.f.flush()
+
+def make_endpoint(spec):
+    # "usb"/None: 实体设备；"null"；"file:<路径>"；"mock" 或 "mock:latency=0.025,bandwidth=6e6,error_rate=0.01"
+    if not spec or spec == "usb": return None
+    kind, _, arg = spec.partition(":")
+    if kind == "null": return NullEndpoint()
+    if kind == "file" and arg: return FileEndpoint(arg)
+    if kind == "mock":
+        opts = dict(item.split("=", 1) for item in arg.split(",") if item)
+        return MockEndpoint(**{k: float(v) for k, v in opts.items()})
+    raise ValueError(f"Unknown display backend: {spec}")
+
+# --- 多设备选择 ---
+# 同型号的多块屏按物理接口（总线-端口链，如 "1-4.2"，换线不换口时保持不变）或序列号（"serial:<SN>"）区分
+def device_path(dev):
+    ports = getattr(dev, "port_numbers", None) or ([dev.port_number] if getattr(dev, "port_number", None) else [])
+    return f"{dev.bus}-{'.'.join(str(p) for p in ports)}"
+
+def device_serial(dev):
+    # 读字符串描述符需要权限，且设备可能正被占用
+    try: return usb.util.get_string(dev, dev.iSerialNumber) if dev.iSerialNumber else None
+    except Exception: return None
+
+def device_matches(dev, match):
+    if not match: return True
+    if match.startswith("serial:"): return device_serial(dev) == match[7:]
+    return device_path(dev) == match
+
+def find_panels(vendor_id=0x3633, product_id=0x0026, match=None):
+    return [dev for dev in usb.core.find(find_all=True, idVendor=vendor_id, idProduct=product_id) if device_matches(dev, match)]
+
 class DeepCoolScreen:
     PACKET_HEADER = bytes.fromhex("aa08000001005802002c01bc11")
     WIDTH, HEIGHT, IMG_SIZE = 320, 240, 153600
+    # 时序取自抓包：官方软件帧头与像素数据间隔约 2ms，两条初始化指令间隔约 25ms，
+    # 一帧 153600 字节的 bulk 传输约 25ms 完成
+    HEADER_GAP = 0.002
+    INIT_GAP = 0.025
+    BACKOFF_MIN, BACKOFF_MAX = 0.1, 5.0
 
-    def __init__(self, vendor_id=0x3633, product_id=0x0026):
+    def __init__(self, vendor_id=0x3633, product_id=0x0026, header_gap=None, chunk_size=0, backend=None, match=None, name="default"):
         self.vendor_id = vendor_id
         self.product_id = product_id
+        self.backend = backend  # 非 None 时不访问 USB，直接写到该端点对象
+        self.match = match  # 多屏时只绑定接口路径/序列号匹配的设备，None 为第一个找到的
+        self.name = name
+        self.tag = "" if name == "default" else f"[{name}] "
         self.dev = None
         self.ep_out = None
-        self.last_buffer_hash = None
+        self.last_buffer = None
+        self.connections = 0
+        self.header_gap = self.HEADER_GAP if header_gap is None else header_gap
+        # >0 时按块提交像素数据。必须是 512（高速 bulk 包长）的倍数，否则帧中间出现短包，设备会提前结束这次传输
+        chunk = max(0, int(chunk_size or 0))
+        self.chunk_size = chunk - chunk % 512
+        if self.chunk_size != chunk: print(f"{self.tag}usb_chunk_size {chunk_size} rounded down to {self.chunk_size}")
+        self.transfer_stats = StageStats()
+        self.hash_stats = StageStats()
+        self.usb_errors = 0
+        self.display_errors = 0
+        self.dedupe_hits = 0
+        self.frames_written = 0
+        self.last_error = None
+        self.reconnects = 0
+        self.backoff = 0.0
+        self.next_connect = 0.0
         self.font_large = self._load_font(45)
         self.font_med = self._load_font(22)
         self.font_small = self._load_font(13)
-        self._connect_device()
+        self._connect_device(reset=True)
 
     def _load_font(self, size):
         font_paths = [
@@ -240,290 +1155,1653 @@ class DeepCoolScreen:
             if os.path.exists(p): return ImageFont.truetype(p, size)
         return ImageFont.load_default()
 
-    def _connect_device(self):
+    def _connect_device(self, reset=False):
         try:
-            if self.dev: usb.util.dispose_resources(self.dev)
-            self.dev = usb.core.find(idVendor=self.vendor_id, idProduct=self.product_id)
-            if not self.dev: return False
-
-            # 强制复位
-            try: self.dev.reset()
-            except: pass
-            time.sleep(0.5)
-
-            if self.dev.is_kernel_driver_active(0): self.dev.detach_kernel_driver(0)
-            self.dev.set_configuration()
-            cfg = self.dev.get_active_configuration()
-            intf = cfg[(0, 0)]
-            self.ep_out = usb.util.find_descriptor(intf, custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+            if self.backend:
+                self.dev = self.ep_out = self.backend
+            else:
+                if self.dev: usb.util.dispose_resources(self.dev)
+                panels = find_panels(self.vendor_id, self.product_id, self.match)
+                self.dev = panels[0] if panels else None
+                if not self.dev: return False
+
+                if reset:
+                    # 强制复位（仅首次连接或普通重连失败时）
+                    try: self.dev.reset()
+                    except: pass
+                    time.sleep(0.5)
+
+                if self.dev.is_kernel_driver_active(0): self.dev.detach_kernel_driver(0)
+                self.dev.set_configuration()
+                cfg = self.dev.get_active_configuration()
+                intf = cfg[(0, 0)]
+                self.ep_out = usb.util.find_descriptor(intf, custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
 
             # 握手
             self.ep_out.write(bytes.fromhex("aa04000603640027b9"), timeout=2000)
-            time.sleep(0.05)
+            time.sleep(self.INIT_GAP)
             self.ep_out.write(bytes.fromhex("aa0100092991"), timeout=2000)
-            time.sleep(0.05)
+            time.sleep(self.INIT_GAP)
             self.ep_out.write(self.PACKET_HEADER, timeout=2000)
 
-            print("Device connected & Reset.")
-            self.last_buffer_hash = None
+            print(self.tag + ("Device connected & Reset." if reset else "Device connected."))
+            self.last_buffer = None
+            self.connections += 1
             return True
         except Exception as e:
-            print(f"Connect error: {e}")
+            print(f"{self.tag}Connect error: {e}")
             self.dev = None
             self.ep_out = None
             return False
 
+    def _reconnect(self):
+        # 先不复位直接重连，失败再复位；连续失败按指数退避，期间直接丢帧
+        if time.monotonic() < self.next_connect: return False
+        self.reconnects += 1
+        if self._connect_device() or self._connect_device(reset=True):
+            self.backoff = 0.0
+            return True
+        self.backoff = min(max(self.backoff * 2, self.BACKOFF_MIN), self.BACKOFF_MAX)
+        self.next_connect = time.monotonic() + self.backoff
+        return False
+
+    def _write_frame(self, buffer):
+        self.ep_out.write(self.PACKET_HEADER, timeout=1000)
+        if self.header_gap: time.sleep(self.header_gap)
+        if self.chunk_size:
+            # 分块提交，每块单独超时，设备卡住时能更快发现
+            for off in range(0, len(buffer), self.chunk_size):
+                self.ep_out.write(buffer[off:off + self.chunk_size], timeout=1000)
+        else:
+            self.ep_out.write(buffer, timeout=5000)
+
+    def send_frame(self, buffer):
+        # buffer: 编码好的 RGB565 数据；返回是否真正写到了设备
+        if not self.ep_out and not self._reconnect(): return False
+        start = time.perf_counter()
+        try:
+            self._write_frame(buffer)
+        except usb.core.USBError as e:
+            self.usb_errors += 1
+            self.last_error = f"USBError: {e}"
+            try:
+                # 轻量恢复：清除端点 halt 后重发一次，不动连接
+                self.dev.clear_halt(self.ep_out)
+                self._write_frame(buffer)
+            except usb.core.USBError as e:
+                # 同一帧的重试失败不再计数：usb_errors 是出错的帧数
+                print(f"{self.tag}USB Timeout/Error, reconnecting...")
+                self.last_error = f"USBError: {e}"
+                self.last_buffer = None
+                self.ep_out = None
+                self._reconnect()
+                return False
+        except Exception as e:
+            self.display_errors += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            return False
+        self.transfer_stats.record(time.perf_counter() - start)
+        self.frames_written += 1
+        return True
+
+    def snapshot(self):
+        res = {"name": self.name, "match": self.match, "connected": self.ep_out is not None, "transfer": self.transfer_stats.snapshot(),
+               "usb_errors": self.usb_errors, "reconnects": self.reconnects, "header_gap_ms": self.header_gap * 1000,
+               "chunk_size": self.chunk_size, "dedupe_hits": self.dedupe_hits, "display_errors": self.display_errors}
+        if self.backend: res["backend"] = {"type": type(self.backend).__name__, **self.backend.snapshot()}
+        return res
+
     def display(self, img):
-        if not self.ep_out:
-            if not self._connect_device(): return
-
-        if img.size != (self.WIDTH, self.HEIGHT):
-            img = img.resize((self.WIDTH, self.HEIGHT))
-
-        pixels = img.getdata()
-        buffer = bytearray(self.IMG_SIZE)
-        idx = 0
-        for r, g, b in pixels:
-            r5, g6, b5 = (r >> 3) & 0x1F, (g >> 2) & 0x3F, (b >> 3) & 0x1F
-            rgb565 = (r5 << 11) | (g6 << 5) | b5
-            struct.pack_into('<H', buffer, idx, rgb565)
-            idx += 2
-
-        # 去重
-        current_hash = hashlib.md5(buffer).digest()
-        if self.last_buffer_hash == current_hash:
+        if isinstance(img, (bytes, bytearray, memoryview)):
+            # 已编码的 RGB565 帧
+            buffer = img.tobytes() if isinstance(img, memoryview) else img
+        elif isinstance(img, np.ndarray):
+            # OpenCV BGR 帧，跳过 PIL 直接编码
+            if img.shape[:2] != (self.HEIGHT, self.WIDTH):
+                img = cv2.resize(img, (self.WIDTH, self.HEIGHT), interpolation=cv2.INTER_AREA)
+            buffer = encode_rgb565(img, bgr=True)
+        else:
+            if img.size != (self.WIDTH, self.HEIGHT):
+                img = img.resize((self.WIDTH, self.HEIGHT))
+            buffer = encode_rgb565(img.convert("RGB"))
+
+        # 去重：直接和上一帧逐字节比较（memcmp，遇到第一个差异即返回），比 MD5 便宜得多
+        start = time.perf_counter()
+        same = buffer == self.last_buffer
+        self.hash_stats.record(time.perf_counter() - start)
+        if same:
+            self.dedupe_hits += 1
+            return False
+
+        if not self.send_frame(buffer): return False
+        self.last_buffer = buffer if isinstance(buffer, bytes) else bytes(buffer)
+        return True
+
+# --- 帧流水线 ---
+# 耗时直方图的桶上界：10us 起每个倍频程 4 个桶，到约 10s，超出的落在最后一个溢出桶
+HIST_BOUNDS = [1e-5 * 2 ** (i / 4) for i in range(81)]
+
+class StageStats:
+    # 单个阶段的耗时统计：计数/均值/最大值 + 固定大小的对数直方图（内存不随运行时间增长）
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * (len(HIST_BOUNDS) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max: self.max = seconds
+        self.buckets[bisect_right(HIST_BOUNDS, seconds)] += 1
+
+    @classmethod
+    def merged(cls, stats):
+        # 多块屏的同一阶段合并成一个分布：桶逐项相加
+        res = cls()
+        for st in stats:
+            res.count += st.count
+            res.total += st.total
+            res.max = max(res.max, st.max)
+            res.last = st.last or res.last
+            res.buckets = [a + b for a, b in zip(res.buckets, st.buckets)]
+        return res
+
+    def percentile(self, q):
+        # 返回所在桶的上界（误差不超过 19%），不超过实测最大值
+        target, seen = q * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target: return min(HIST_BOUNDS[i] if i < len(HIST_BOUNDS) else self.max, self.max)
+        return self.max
+
+    def snapshot(self, histogram=False):
+        avg = self.total / self.count if self.count else 0.0
+        res = {"count": self.count, "avg_ms": round(avg * 1000, 3), "max_ms": round(self.max * 1000, 3), "last_ms": round(self.last * 1000, 3)}
+        if self.count:
+            for q in (50, 90, 99): res[f"p{q}_ms"] = round(self.percentile(q / 100) * 1000, 3)
+        if histogram:
+            # 只输出非空桶：[桶上界 ms, 次数]，溢出桶上界为 null
+            res["histogram"] = [[round(HIST_BOUNDS[i] * 1000, 3) if i < len(HIST_BOUNDS) else None, n] for i, n in enumerate(self.buckets) if n]
+        return res
+
+class PerfStats:
+    # 取帧端各阶段耗时，每路内容（ServiceState）一份，只由它自己的取帧线程写入。
+    # 去重比较和 USB 写入按设备统计在 DeepCoolScreen 上
+    STAGES = ("acquire", "render", "brightness", "encode", "sleep_slack")
+
+    def __init__(self):
+        self.stages = {name: StageStats() for name in self.STAGES}
+        self.started = time.monotonic()
+
+    def record(self, stage, seconds):
+        self.stages[stage].record(seconds)
+
+    def reset(self):
+        for s in self.stages.values(): s.reset()
+
+class FrameQueue:
+    # 有界队列：设备跟不上时丢弃最旧的帧，保证写出去的总是最新画面
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.put_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.depth_sum = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.put_count += 1
+            self.depth_sum += len(self.items)
+            if len(self.items) > self.max_depth: self.max_depth = len(self.items)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items, timeout): return None
+            return self.items.popleft()
+
+    def snapshot(self):
+        with self.cond:
+            avg = self.depth_sum / self.put_count if self.put_count else 0.0
+            return {"depth": len(self.items), "max_depth": self.max_depth, "avg_depth": round(avg, 2),
+                    "capacity": self.maxsize, "put": self.put_count, "dropped": self.dropped}
+
+class FramePipeline:
+    # 生产者（主循环：取帧/渲染/编码）-> 有界队列 -> 独占 USB 端点的写线程
+    IDLE_RETRY = 1.0  # 队列空闲多久检查一次断开的屏
+
+    def __init__(self, screen, depth=2):
+        self.screen = screen
+        self.name = screen.name
+        self.queue = FrameQueue(depth)
+        self.produce_stats = StageStats()
+        self.write_stats = StageStats()
+        self.write_ewma = 0.0  # 实测单帧 USB 传输耗时（只统计真正写出的帧）
+        self.errors = 0
+        self.brightness = 1.0
+        self.dimmer = None  # 这块屏自己的亮度：在写线程里对编码好的帧查表调暗，叠加在内容亮度之上
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+
+    @property
+    def connections(self):
+        return self.screen.connections
+
+    def start(self):
+        self.thread.start()
+
+    def set_brightness(self, level):
+        self.dimmer = Rgb565Encoder(level) if level < 1.0 else None
+        self.brightness = level
+
+    def submit(self, buf, produce_time=0.0):
+        self.produce_stats.record(produce_time)
+        self.queue.put(buf)
+
+    def _writer_loop(self):
+        while True:
+            buf = self.queue.get(self.IDLE_RETRY)
+            if buf is None:
+                # 静态画面不会再提交新帧：空闲时自己重连（按退避节奏），连上后取帧端会重推完整画面
+                if self.screen.ep_out is None: self.screen._reconnect()
+                continue
+            start = time.perf_counter()
+            dimmer = self.dimmer
+            try: written = self.screen.display(dimmer.apply(buf) if dimmer else buf)
+            except Exception as e:
+                # 写线程不能因为一帧出错而退出
+                self.errors += 1
+                self.screen.last_error = f"{type(e).__name__}: {e}"
+                written = False
+            elapsed = time.perf_counter() - start
+            self.write_stats.record(elapsed)
+            if written: self.write_ewma = elapsed if not self.write_ewma else self.write_ewma * 0.8 + elapsed * 0.2
+
+    def counters(self):
+        s = self.screen
+        return {"frames_written": s.frames_written, "dropped": self.queue.dropped, "dedupe_hits": s.dedupe_hits,
+                "reconnects": s.reconnects, "usb_errors": s.usb_errors, "display_errors": s.display_errors + self.errors}
+
+    def snapshot(self):
+        return {"produce": self.produce_stats.snapshot(), "queue": self.queue.snapshot(), "write": self.write_stats.snapshot()}
+
+class FanOut:
+    # 一路内容驱动多块屏：每帧只取帧/渲染/编码一次，放进每块屏各自的队列。
+    # 慢屏或断开的屏只会在自己的队列里丢旧帧，不拖慢其他屏
+    def __init__(self, pipelines=()):
+        self.pipelines = list(pipelines)  # 只整体替换，写线程外的读者不需要加锁
+        self.produce_stats = StageStats()
+        self.version = 0
+
+    def add(self, pipeline):
+        self.pipelines = self.pipelines + [pipeline]
+        self.version += 1
+
+    def remove(self, pipeline):
+        self.pipelines = [p for p in self.pipelines if p is not pipeline]
+        self.version += 1
+
+    @property
+    def write_ewma(self):
+        # 按最快的在线屏限速，慢屏自行丢帧
+        ewmas = [p.write_ewma for p in self.pipelines if p.write_ewma and p.screen.ep_out is not None]
+        return min(ewmas) if ewmas else 0.0
+
+    @property
+    def connections(self):
+        # 增减屏或任一屏重连时都会变化，取帧端据此重推完整画面
+        return self.version, sum(p.connections for p in self.pipelines)
+
+    def submit(self, buf, produce_time=0.0):
+        self.produce_stats.record(produce_time)
+        for p in self.pipelines: p.queue.put(buf)
+
+    def snapshot(self):
+        return {"produce": self.produce_stats.snapshot(),
+                "devices": {p.name: {"queue": p.queue.snapshot(), "write": p.write_stats.snapshot(), "usb": p.screen.snapshot()} for p in self.pipelines}}
+
+# --- 帧调度 ---
+class FrameScheduler:
+    # 基于单调时钟的绝对截止时间调度：慢帧之后不拉长播放，而是跳帧追上时间轴；
+    # 输出帧率同时受源帧率和实测 USB 吞吐限制
+    def __init__(self, pipeline, perf=None):
+        self.pipeline = pipeline
+        self.perf = perf or PerfStats()
+        self.deadline = None
+        self.interval_s = 0.0
+        self.media_key = None
+        self.media_start = 0.0
+        self.shown = -1
+        self.late = 0
+        self.skipped = 0
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        # 换源时打断当前等待，新内容立即上屏
+        self.wakeup.set()
+
+    def panel_fps(self):
+        ewma = self.pipeline.write_ewma
+        return 1.0 / ewma if ewma > 0 else None
+
+    def reset_media(self):
+        self.media_key = None
+
+    def interval(self, fps):
+        return max(1.0 / fps, self.pipeline.write_ewma)
+
+    def media_time(self, key):
+        # 当前媒体从开始播放到现在的秒数；媒体变化时重新计时
+        now = time.monotonic()
+        if key != self.media_key:
+            self.media_key, self.media_start, self.shown = key, now, -1
+        return now - self.media_start
+
+    def frames_to_skip(self, key, fps):
+        # 按媒体时间轴计算当前应显示的源帧，返回需要丢弃的帧数
+        self.media_time(key)
+        now = time.monotonic()
+        due = int((now - self.media_start) * fps)
+        skip = max(0, due - self.shown - 1)
+        if skip > max(1, int(fps)):
+            # 落后超过 1 秒（挂起、长时间阻塞等）：重新对齐时间轴，不再逐帧追赶
+            self.media_start = now - (self.shown + 1) / fps
+            skip = 0
+        self.shown += skip + 1
+        self.skipped += skip
+        return skip
+
+    def wait_until(self, deadline):
+        # 可变帧时长（动图）：直接以下一次换帧的绝对时间为截止时间，并受 USB 吞吐限制
+        now = time.monotonic()
+        self.deadline = now
+        self.wait(max(deadline - now, self.pipeline.write_ewma))
+
+    def wait(self, interval):
+        self.interval_s = interval
+        now = time.monotonic()
+        if self.deadline is None: self.deadline = now
+        self.deadline += interval
+        if self.deadline < now:
+            # 错过截止时间：不补帧，以当前时间重新对齐
+            self.late += 1
+            self.deadline = now
+            self.perf.record("sleep_slack", 0.0)
             return
+        self.perf.record("sleep_slack", self.deadline - now)
+        if self.wakeup.wait(self.deadline - now):
+            self.wakeup.clear()
+            self.deadline = time.monotonic()
 
-        try:
-            self.ep_out.write(self.PACKET_HEADER, timeout=1000)
-            time.sleep(0.02)
-            self.ep_out.write(buffer, timeout=5000)
-            self.last_buffer_hash = current_hash
-        except usb.core.USBError:
-            print("USB Timeout/Error, reconnecting...")
-            self.last_buffer_hash = None
-            self._connect_device()
-        except Exception: pass
+    def snapshot(self):
+        panel = self.panel_fps()
+        return {"effective_fps": round(1.0 / self.interval_s, 2) if self.interval_s else None,
+                "panel_max_fps": round(panel, 2) if panel else None,
+                "late": self.late, "skipped": self.skipped}
 
 # --- UI 绘制 ---
+C_BG, C_DIM, C_ACCENT = "#111111", "#777777", "#00CCFF"
+LABEL_Y, CONTENT_Y, L_MARGIN, R_MARGIN = 40, 65, 30, 160
+GH, GY = 50, 240
+
+class MonitorRenderer:
+    # 分层渲染：静态背景（标题栏、标签、圆弧底槽、网格）只画一次，
+    # 每帧只重画数值发生变化的区域，并只重新编码这些区域
+    REGIONS = {
+        "header": (0, 0, 320, 29),
+        "temp": (0, 29, 155, 190),
+        "load": (155, 29, 320, 110),
+        "power": (155, 110, 320, 190),
+        "graph": (0, 190, 320, 240),
+    }
+
+    def __init__(self, screen_obj):
+        self.screen = screen_obj
+        self.background = None
+        self.bg_key = None
+        self.canvas = None
+        self.frame = bytearray(FRAME_BYTES)
+        self.pixels = np.frombuffer(self.frame, dtype='<u2').reshape(240, 320)
+        self.values = {}
+        self.level = None
+
+    def _text_w(self, draw, text, font, fallback):
+        try: return draw.textbbox((0, 0), text, font=font)[2]
+        except: return fallback
+
+    def _build_background(self, hostname):
+        s = self.screen
+        image = Image.new("RGB", (320, 240), "#000000")
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, 320, 28), fill=C_BG)
+        host_str = f"{hostname.upper()}'s PC"
+        draw.text((8, 5), host_str, font=s.font_small, fill="#FFFFFF")
+        self.host_w = self._text_w(draw, host_str, s.font_small, 80)
+
+        draw.text((L_MARGIN + 17, LABEL_Y), "CPU TEMP", font=s.font_small, fill=C_DIM)
+        self.arc_box = (L_MARGIN - 5, CONTENT_Y, L_MARGIN + 95, CONTENT_Y + 100)
+        draw.arc(self.arc_box, 0, 360, "#222222", 5)
+
+        draw.text((R_MARGIN, LABEL_Y), "CPU LOAD", font=s.font_small, fill=C_DIM)
+        draw.rectangle((R_MARGIN, CONTENT_Y, 300, CONTENT_Y + 12), fill="#222222")
+        draw.text((R_MARGIN, 115), "POWER", font=s.font_small, fill=C_DIM)
+
+        draw.rectangle((0, GY-GH, 320, GY), fill="#080808")
+        for i in range(1, 4): draw.line((0, GY - GH*i//4, 320, GY - GH*i//4), "#2A2A2A")
+        for i in range(1, 5): draw.line((320*i//5, GY-GH, 320*i//5, GY), "#2A2A2A")
+        draw.line((0, GY-GH, 320, GY-GH), "#333333")
+        self.background = image
+        self.canvas = image.copy()
+        self.values = {}
+
+    # 各区域的绘制函数：在区域自己的小图上画，(ox, oy) 为区域左上角
+    def _draw_header(self, draw, ox, oy, v):
+        s = self.screen
+        uptime_str, total_str = v
+        total_w = self._text_w(draw, total_str, s.font_small, 60)
+        draw.text((320 - total_w - 8 - ox, 5 - oy), total_str, font=s.font_small, fill=C_ACCENT)
+        left_end, right_start = 8 + self.host_w, 320 - total_w - 8
+        center_point = (left_end + right_start) // 2
+        uptime_w = self._text_w(draw, uptime_str, s.font_small, 80)
+        draw.text((center_point - (uptime_w // 2) - ox, 5 - oy), uptime_str, font=s.font_small, fill="#FFFFFF")
+
+    def _draw_temp(self, draw, ox, oy, v):
+        temp_i, arc_end, c_temp = v
+        box = self.arc_box
+        draw.arc((box[0] - ox, box[1] - oy, box[2] - ox, box[3] - oy), 270, arc_end, c_temp, 5)
+        off_x = 0 if temp_i < 100 else -10
+        draw.text((L_MARGIN + 15 + off_x - ox, CONTENT_Y + 18 - oy), f"{temp_i}°", font=self.screen.font_large, fill="#FFFFFF")
+
+    def _draw_load(self, draw, ox, oy, v):
+        usage_str, bar_w = v
+        draw.rectangle((R_MARGIN - ox, CONTENT_Y - oy, R_MARGIN + bar_w - ox, CONTENT_Y + 12 - oy), fill=C_ACCENT)
+        draw.text((R_MARGIN - ox, CONTENT_Y + 15 - oy), f"{usage_str}%", font=self.screen.font_med, fill="#FFFFFF")
+
+    def _draw_power(self, draw, ox, oy, v):
+        draw.text((R_MARGIN - ox, 135 - oy), f"{v} W", font=self.screen.font_med, fill="#FFAA00")
+
+    def _draw_graph(self, draw, ox, oy, v):
+        if len(v) > 1: draw.line([(x - ox, y - oy) for x, y in v], fill=C_ACCENT, width=2)
+
+    def _sample(self, monitor):
+        # 把监控数据量化成屏幕上实际显示的值，值不变则区域不重画
+        temp, usage, power = monitor.get_cpu_temp(), monitor.get_cpu_usage(), monitor.get_cpu_power()
+        c_temp = "#00FF00"
+        if temp > 65: c_temp = "#FFD700"
+        if temp > 75: c_temp = "#FF3300"
+        history = monitor.usage_history
+        step = 320 / (len(history) - 1)
+        pts = tuple((int(i * step), min(max(int(GY - (val / 100 * GH)), GY - GH + 1), GY - 1)) for i, val in enumerate(history))
+        return {
+            "header": (monitor.get_uptime_str(), monitor.get_total_runtime_str()),
+            "temp": (int(temp), 270 + int(360 * (temp / 100)), c_temp),
+            "load": (f"{usage:.1f}", int((300-R_MARGIN)*(usage/100))),
+            "power": f"{power:.1f}",
+            "graph": pts,
+        }
+
+    def invalidate(self):
+        # 切回监控模式等场景：强制下一帧整屏重画
+        self.values = {}
+        self.level = None
+
+    def render(self, monitor, encoder=None):
+        # 返回本帧被重画的区域名列表；为空表示画面与上一帧相同
+        s = self.screen
+        bg_key = (monitor.hostname, id(s.font_small), id(s.font_med), id(s.font_large))
+        if bg_key != self.bg_key:
+            self._build_background(monitor.hostname)
+            self.bg_key = bg_key
+        values = self._sample(monitor)
+        dirty = [name for name, v in values.items() if self.values.get(name) != v]
+        for name in dirty:
+            box = self.REGIONS[name]
+            region = self.background.crop(box)
+            getattr(self, "_draw_" + name)(ImageDraw.Draw(region), box[0], box[1], values[name])
+            self.canvas.paste(region, box[:2])
+            self.values[name] = values[name]
+        if encoder is None: return dirty
+        if encoder.level != self.level:
+            # 亮度变化：无需重新栅格化，整屏重新编码即可
+            self.pixels[:] = encoder.pack(np.asarray(self.canvas))
+            self.level = encoder.level
+            return list(self.REGIONS)
+        arr = np.asarray(self.canvas) if dirty else None
+        for name in dirty:
+            x0, y0, x1, y1 = self.REGIONS[name]
+            self.pixels[y0:y1, x0:x1] = encoder.pack(arr[y0:y1, x0:x1])
+        return dirty
+
 def draw_monitor_ui(screen_obj, monitor):
-    image = Image.new("RGB", (320, 240), "#000000")
-    draw = ImageDraw.Draw(image)
-    temp, usage, power = monitor.get_cpu_temp(), monitor.get_cpu_usage(), monitor.get_cpu_power()
-
-    C_BG, C_DIM, C_ACCENT = "#111111", "#777777", "#00CCFF"
-    c_temp = "#00FF00"
-    if temp > 65: c_temp = "#FFD700"
-    if temp > 75: c_temp = "#FF3300"
-
-    draw.rectangle((0, 0, 320, 28), fill=C_BG)
-
-    host_str = f"{monitor.hostname.upper()}'s PC"
-    draw.text((8, 5), host_str, font=screen_obj.font_small, fill="#FFFFFF")
-    try: host_w = draw.textbbox((0, 0), host_str, font=screen_obj.font_small)[2]
-    except: host_w = 80
-
-    total_str = monitor.get_total_runtime_str()
-    try: total_w = draw.textbbox((0, 0), total_str, font=screen_obj.font_small)[2]
-    except: total_w = 60
-    draw.text((320 - total_w - 8, 5), total_str, font=screen_obj.font_small, fill=C_ACCENT)
-
-    left_end = 8 + host_w
-    right_start = 320 - total_w - 8
-    center_point = (left_end + right_start) // 2
-    uptime_str = monitor.get_uptime_str()
-    try: uptime_w = draw.textbbox((0, 0), uptime_str, font=screen_obj.font_small)[2]
-    except: uptime_w = 80
-    draw.text((center_point - (uptime_w // 2), 5), uptime_str, font=screen_obj.font_small, fill="#FFFFFF")
-
-    LABEL_Y, CONTENT_Y, L_MARGIN, R_MARGIN = 40, 65, 30, 160
-    draw.text((L_MARGIN + 17, LABEL_Y), "CPU TEMP", font=screen_obj.font_small, fill=C_DIM)
-    arc_box = (L_MARGIN - 5, CONTENT_Y, L_MARGIN + 95, CONTENT_Y + 100)
-    draw.arc(arc_box, 0, 360, "#222222", 5)
-    draw.arc(arc_box, 270, 270 + int(360 * (temp / 100)), c_temp, 5)
-    off_x = 0 if temp < 100 else -10
-    draw.text((L_MARGIN + 15 + off_x, CONTENT_Y + 18), f"{int(temp)}°", font=screen_obj.font_large, fill="#FFFFFF")
-
-    draw.text((R_MARGIN, LABEL_Y), "CPU LOAD", font=screen_obj.font_small, fill=C_DIM)
-    draw.rectangle((R_MARGIN, CONTENT_Y, 300, CONTENT_Y + 12), fill="#222222")
-    draw.rectangle((R_MARGIN, CONTENT_Y, R_MARGIN + int((300-R_MARGIN)*(usage/100)), CONTENT_Y + 12), fill=C_ACCENT)
-    draw.text((R_MARGIN, CONTENT_Y + 15), f"{usage:.1f}%", font=screen_obj.font_med, fill="#FFFFFF")
-
-    draw.text((R_MARGIN, 115), "POWER", font=screen_obj.font_small, fill=C_DIM)
-    draw.text((R_MARGIN, 135), f"{power:.1f} W", font=screen_obj.font_med, fill="#FFAA00")
-
-    GH, GY = 50, 240
-    draw.rectangle((0, GY-GH, 320, GY), fill="#080808")
-    for i in range(1, 4): draw.line((0, GY - GH*i//4, 320, GY - GH*i//4), "#2A2A2A")
-    for i in range(1, 5): draw.line((320*i//5, GY-GH, 320*i//5, GY), "#2A2A2A")
-    draw.line((0, GY-GH, 320, GY-GH), "#333333")
-
-    pts = []
-    step = 320 / (len(monitor.usage_history) - 1)
-    for i, val in enumerate(monitor.usage_history):
-        y = int(GY - (val / 100 * GH))
-        pts.append((int(i * step), min(max(y, GY - GH + 1), GY - 1)))
-    if len(pts) > 1: draw.line(pts, fill=C_ACCENT, width=2)
-    return image
+    renderer = MonitorRenderer(screen_obj)
+    renderer.render(monitor)
+    return renderer.canvas
 
 # --- 服务端状态管理 ---
+class LoadedMedia:
+    # 在后台加载好的媒体源，ServiceState.apply_media 时一次性换上
+    def __init__(self, path, fit, mode):
+        self.path, self.fit, self.mode = path, fit, mode
+        self.static_image = None
+        self.animation = None
+        self.video_cap = None
+        self.video_cache = None
+        self.video_fps = 30.0
+        self.video_decoder = None
+        self.frame_store = None
+        self.duration = None  # 一轮播放的时长（秒），静态图为 None
+        self.needs_cache = False
+
+    def close(self):
+        if self.video_cap: self.video_cap.release()
+        if self.video_cache: self.video_cache.close()
+        self.video_cap = self.video_cache = self.frame_store = None
+
+class Playlist:
+    # 轮播：依次显示媒体文件和监控画面；当前项显示期间在后台预加载下一项，到点直接换上
+    DEFAULT_INTERVAL = 30.0
+
+    def __init__(self, state, items, loop=True):
+        self.state = state
+        self.items = [dict(item) for item in items]
+        self.loop = loop
+        self.index = 0
+        self.deadline = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _load(self, item):
+        if not item.get("path"): return None
+        media, msg = self.state.load_media(item["path"], item.get("fit", 'contain'), item.get("decoder"))
+        if not media: print(f"Playlist: skipping {item['path']}: {msg}")
+        return media
+
+    def _show(self, item, media):
+        # 在状态锁内检查是否已被手动命令停止，避免停止后又换上一项
+        with self.state.lock:
+            if self.stopped.is_set(): return False
+            if media: self.state.apply_media(media, persist=False)
+            else: self.state.show_monitor(persist=False)
+        return True
+
+    def _run(self):
+        items, failures = self.items, 0
+        media = self._load(items[0])
+        while not self.stopped.is_set():
+            item = items[self.index]
+            if item.get("path") and not media:
+                failures += 1
+                if failures >= len(items):
+                    print("Playlist: no playable items, stopping")
+                    return self._finish()
+            else:
+                failures = 0
+                if not self._show(item, media):
+                    if media: media.close()
+                    return
+            duration = item.get("duration") or (media.duration if media else None) or self.DEFAULT_INTERVAL
+            # 加载失败的项不停留，直接换到下一项
+            self.deadline = time.monotonic() + (duration if failures == 0 else 0)
+            nxt = self.index + 1
+            if nxt >= len(items):
+                if not self.loop:
+                    # 最后一项照常显示到时，之后保持在这一项
+                    if not self.stopped.wait(max(0.0, self.deadline - time.monotonic())): self._finish()
+                    return
+                nxt = 0
+            media = self._load(items[nxt])
+            if self.stopped.wait(max(0.0, self.deadline - time.monotonic())):
+                if media: media.close()
+                return
+            self.index = nxt
+
+    def _finish(self):
+        # 自己结束（非循环播完、全部无法播放）：清掉状态和设置，否则重启后会再次开始
+        with self.state.lock:
+            if self.state.playlist is not self or self.stopped.is_set(): return
+            state = self.state
+            state.playlist = None
+            # 播完后停在的画面就是重启后要恢复的内容
+            state.save({"playlist": None, "mode": state.mode, "media_path": state.current_media_path})
+
+    def snapshot(self):
+        item = self.items[self.index]
+        left = max(0.0, self.deadline - time.monotonic()) if self.deadline else None
+        return {"index": self.index, "items": len(self.items), "current": item.get("path") or "monitor",
+                "loop": self.loop, "next_in": round(left, 1) if left is not None else None}
+
 class ServiceState:
-    def __init__(self):
+    # channel 为 None 时是所有屏共享的默认内容；多屏时单独控制的屏各有一个以屏名命名的 ServiceState，
+    # 其模式/媒体/亮度等保存在 settings.json 的 channels.<屏名> 下
+    def __init__(self, channel=None, frame_cache=None):
+        self.channel = channel
         self.mode = "MONITOR"
         self.brightness = 1.0
+        self.monitor_fps = 5.0
+        self.encoder = Rgb565Encoder()
+        self.perf = PerfStats()
+        # 主循环取帧和切换媒体源都持有此锁，保证换源是原子的
+        self.lock = threading.RLock()
         self.video_cap = None
+        self.video_cache = None
         self.video_fps = 30.0
+        self.video_fit = 'contain'
+        self.video_decoder = None
         self.static_image = None
+        self.animation = None
+        self.stream = None
+        self.playlist = None
         self.current_media_path = None
+        self.media_version = 0
+        self.monitor = None
+        self.pipeline = None
+        self.scheduler = None
+        # 多屏时各频道共用同一个 FrameCache，同一文件不会被重复转码
+        self.frame_cache = frame_cache or FrameCache(max_bytes=load_settings().get("cache_max_mb", CACHE_MAX_BYTES >> 20) << 20)
+        self.frame_store = None
+        self.ram_budget = load_settings().get("ram_cache_mb", RAM_CACHE_BYTES >> 20) << 20
+        self.ram_stats = {"hits": 0, "misses": 0, "loaded": 0, "rejected": 0}
         self._init_from_settings()
 
     def _cleanup(self):
-        if self.video_cap and self.video_cap.isOpened():
-            self.video_cap.release()
+        with self.lock:
+            if self.video_cap:
+                self.video_cap.release()
+                self.video_cap = None
+            if self.video_cache:
+                self.video_cache.close()
+                self.video_cache = None
+            self.static_image = None
+            self.animation = None
+            self.frame_store = None
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            self.media_version += 1
+            if self.scheduler: self.scheduler.wake()
+
+    def _build_cache(self, path, mode):
+        # 后台转码；完成后若仍在播放同一文件，切换到 mmap 回放
+        try: cached = self.frame_cache.transcode(path, mode)
+        except Exception as e:
+            print(f"Transcode failed: {e}")
+            return
+        if not cached: return
+        with self.lock:
+            if self.current_media_path != path or self.mode != "VIDEO" or not (self.video_cap or self.frame_store):
+                cached.close()
+                return
+            store = self.frame_store
+            if store and not store.complete and store.fill_from(cached):
+                # 内存帧库还在首轮填充时直接从缓存文件整体拷贝
+                cap = self.video_cap
+                if cap: store.seek(int(cap.get(cv2.CAP_PROP_POS_FRAMES)))
+                self.video_cap = None
+                if cap: cap.release()
+            if self.frame_store and self.frame_store.complete:
+                cached.close()
+                return
+            self.frame_store = None
+            cap = self.video_cap
+            if cap: cached.seek(int(cap.get(cv2.CAP_PROP_POS_FRAMES)))
+            self.video_cache = cached
             self.video_cap = None
-        self.static_image = None
+            if cap: cap.release()
+        print(f"Frame cache ready: {path} ({cached.frame_count} frames)")
 
-    def _init_from_settings(self):
+    def settings(self):
         settings = load_settings()
-        self.brightness = settings.get("brightness", 1.0)
+        return settings if self.channel is None else settings.get("channels", {}).get(self.channel, {})
+
+    def save(self, updates):
+        if self.channel is None: update_settings(updates)
+        else: SETTINGS.update_section("channels", self.channel, updates)
+
+    def _init_from_settings(self):
+        settings = self.settings()
+        self.set_brightness(settings.get("brightness", 1.0))
+        self.monitor_fps = settings.get("monitor_fps", 5.0)
         last_mode = settings.get("mode", "MONITOR")
         last_path = settings.get("media_path")
-        if last_mode in ["VIDEO", "STATIC"] and last_path:
-            success, _ = self.set_media(last_path)
-            if not success: self.mode = "MONITOR"
-        else: self.mode = "MONITOR"
-
-    def set_media(self, path):
-        if not os.path.exists(path): return False, "File not found"
-        try:
+        playlist = settings.get("playlist")
+        self.mode = "MONITOR"
+        if playlist: self.set_playlist(playlist.get("items", []), playlist.get("loop", True), persist=False)
+        elif last_mode in ["VIDEO", "STATIC", "ANIMATION"] and last_path: self.set_media(last_path)
+
+    def stop_playlist(self, persist=True):
+        with self.lock:
+            if self.playlist:
+                self.playlist.stop()
+                self.playlist = None
+                if persist: self.save({"playlist": None})
+
+    def set_playlist(self, items, loop=True, persist=True):
+        items = [item if isinstance(item, dict) else ({"path": item} if item != "monitor" else {}) for item in items]
+        if not items: return False, "Empty playlist"
+        for item in items:
+            if item.get("path") and not os.path.exists(item["path"]): return False, f"File not found: {item['path']}"
+        self.stop_playlist(persist=False)
+        self.playlist = Playlist(self, items, loop).start()
+        if persist: self.save({"playlist": {"items": items, "loop": loop}})
+        return True, f"Playlist started ({len(items)} items)"
+
+    def show_monitor(self, persist=True):
+        with self.lock:
             self._cleanup()
+            self.mode = "MONITOR"
+            self.current_media_path = None
+        if persist: self.save({"mode": "MONITOR"})
+
+    def set_stream(self, path):
+        try: source = StreamSource(path)
+        except (OSError, ValueError) as e: return False, str(e)
+        with self.lock:
+            self.stop_playlist()
+            self._cleanup()
+            self.stream = source
+            self.mode = "STREAM"
+            self.current_media_path = None
+        return True, f"Stream attached ({source.format}, {source.slots} slots)"
+
+    def set_brightness(self, level):
+        self.brightness = level
+        self.encoder.set_level(level)
+
+    def _make_store(self, frame_count):
+        # 帧数已知且整段能放进内存预算时才建内存帧库
+        if frame_count <= 0: return None
+        if frame_count * FRAME_BYTES > self.ram_budget:
+            self.ram_stats["rejected"] += 1
+            return None
+        self.ram_stats["loaded"] += 1
+        return FrameStore(frame_count)
+
+    def ram_snapshot(self):
+        store = self.frame_store
+        state = "off" if not store else ("ready" if store.complete else "filling")
+        return {"budget_mb": self.ram_budget >> 20, "state": state, "bytes": len(store.data) if store else 0,
+                "frames": store.filled if store else 0, **self.ram_stats}
+
+    def _open_decoder(self, cap, path, fps, fit, decoder):
+        # 默认有 ffmpeg 就用 ffmpeg（解码时直接缩放并转 RGB565），否则或启动失败时用 OpenCV
+        decoder = decoder or load_settings().get("video_decoder", "auto")
+        if decoder != "opencv":
+            if ffmpeg_path():
+                try:
+                    ff = FFmpegVideo(path, fps, fit)
+                    cap.release()
+                    return ff, "ffmpeg"
+                except (OSError, ValueError) as e: print(f"ffmpeg decoder failed: {e}, falling back to OpenCV")
+            elif decoder == "ffmpeg": print("ffmpeg not found, falling back to OpenCV")
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return cap, "opencv"
+
+    def load_media(self, path, fit='contain', decoder=None):
+        # 只打开/解码新文件，不动当前正在播放的内容；返回 (LoadedMedia 或 None, 消息)
+        if not os.path.exists(path): return None, "File not found"
+        try:
+            try:
+                anim = load_animation(path, fit, load_settings().get("anim_budget_mb", ANIM_BUDGET_BYTES >> 20) << 20)
+            except MemoryError as e:
+                print(f"{e}, falling back to video decoding")
+                anim = None
+            if anim:
+                media = LoadedMedia(path, fit, "ANIMATION")
+                media.animation, media.duration = anim, anim.total
+                return media, f"Animation loaded ({anim.frame_count} frames, {anim.total:.2f}s loop)"
+            cached = self.frame_cache.lookup(path, fit)
+            if cached:
+                media = LoadedMedia(path, fit, "VIDEO")
+                media.video_fps, media.duration = cached.fps, cached.frame_count / cached.fps
+                store = self._make_store(cached.frame_count)
+                if store and store.fill_from(cached):
+                    media.frame_store = store
+                    cached.close()
+                else: media.video_cache = cached
+                return media, f"Video loaded from cache ({media.video_fps} FPS)"
             cap = cv2.VideoCapture(path)
-            if not cap.isOpened(): return False, "Failed to open media"
+            if not cap.isOpened(): return None, "Failed to open media"
             ret, frame = cap.read()
-            if not ret: return False, "Empty media"
+            if not ret:
+                cap.release()
+                return None, "Empty media"
             fps = cap.get(cv2.CAP_PROP_FPS)
             frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-            processed_img = process_frame_cv2(frame, 320, 240, mode='contain')
             if frame_count == 1 or fps <= 0:
-                self.mode = "STATIC"
-                self.static_image = processed_img
+                media = LoadedMedia(path, fit, "STATIC")
+                media.static_image = process_frame_cv2(frame, 320, 240, mode=fit)
                 cap.release()
-                msg = "Static Image loaded"
-            else:
-                self.mode = "VIDEO"
-                self.video_cap = cap
-                self.video_fps = fps if fps > 0 else 30.0
-                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                msg = f"Video loaded ({self.video_fps} FPS)"
-            self.current_media_path = path
-            update_settings({"mode": self.mode, "media_path": path})
-            return True, msg
-        except Exception as e: return False, str(e)
+                return media, "Static Image loaded"
+            media = LoadedMedia(path, fit, "VIDEO")
+            media.video_fps = fps
+            if frame_count > 0: media.duration = frame_count / fps
+            media.video_cap, media.video_decoder = self._open_decoder(cap, path, fps, fit, decoder)
+            media.frame_store = self._make_store(int(frame_count))
+            media.needs_cache = True
+            return media, f"Video loaded ({media.video_fps} FPS, {media.video_decoder})"
+        except Exception as e: return None, str(e)
+
+    def apply_media(self, media, persist=True):
+        # 原子换源：持锁期间主循环不会取帧，旧资源在这里释放
+        with self.lock:
+            self._cleanup()
+            self.static_image, self.animation = media.static_image, media.animation
+            self.video_cap, self.video_cache, self.frame_store = media.video_cap, media.video_cache, media.frame_store
+            self.video_fps, self.video_fit, self.video_decoder = media.video_fps, media.fit, media.video_decoder
+            self.current_media_path = media.path
+            self.mode = media.mode
+        if persist: self.save({"mode": media.mode, "media_path": media.path})
+        if media.needs_cache:
+            threading.Thread(target=self._build_cache, args=(media.path, media.fit), daemon=True).start()
+
+    def set_media(self, path, fit='contain', decoder=None, cancelled=None):
+        # 新文件在调用线程里加载，期间当前内容照常播放；加载失败时保持原样
+        media, msg = self.load_media(path, fit, decoder)
+        if not media: return False, msg
+        with self.lock:
+            if cancelled and cancelled():
+                media.close()
+                return False, "Superseded by a newer command"
+            self.stop_playlist()
+            self.apply_media(media)
+        return True, msg
+
+def _decode_next(state, cap):
+    # 解码下一帧并按满亮度编码；内存帧库在首轮填充时顺带存入。到结尾返回 None
+    start = time.perf_counter()
+    if isinstance(cap, FFmpegVideo):
+        raw = cap.read_frame()
+        if raw is None: return None
+        state.perf.record("acquire", time.perf_counter() - start)
+    else:
+        ret, frame = cap.read()
+        if not ret: return None
+        t1 = time.perf_counter()
+        fitted = fit_frame_cv2(frame, 320, 240, mode=state.video_fit)
+        t2 = time.perf_counter()
+        raw = encode_rgb565(fitted, bgr=True)
+        state.perf.record("acquire", t1 - start)
+        state.perf.record("render", t2 - t1)
+        state.perf.record("encode", time.perf_counter() - t2)
+    state.ram_stats["misses"] += 1
+    store = state.frame_store
+    if store and not store.complete and not store.append(raw):
+        # 实际帧数超出元数据，放弃内存帧库，回退为流式解码
+        state.frame_store = None
+        state.ram_stats["rejected"] += 1
+    return raw
+
+def apply_brightness(state, raw):
+    start = time.perf_counter()
+    out = bytes(state.encoder.apply(raw))
+    state.perf.record("brightness", time.perf_counter() - start)
+    return out
+
+def next_video_frame(state, skip=0):
+    # 取下一帧视频（先丢弃 skip 帧），返回编码好的 RGB565 数据
+    store = state.frame_store
+    if store and store.complete:
+        state.ram_stats["hits"] += 1
+        if skip: store.seek(store.pos + skip)
+        return apply_brightness(state, store.read())
+    cache = state.video_cache
+    if cache:
+        if skip: cache.seek(cache.pos + skip)
+        start = time.perf_counter()
+        frame = cache.read()
+        state.perf.record("acquire", time.perf_counter() - start)
+        return apply_brightness(state, frame)
+    cap = state.video_cap
+    if not (cap and cap.isOpened()): return None
+    raw = None
+    if store:
+        # 填充中：被跳过的帧也要解码存入，否则内存帧库不完整
+        for _ in range(skip + 1):
+            raw = _decode_next(state, cap)
+            if raw is None: break
+    else:
+        if skip:
+            start = time.perf_counter()
+            for _ in range(skip):
+                if not cap.grab(): cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            state.perf.record("acquire", time.perf_counter() - start)
+        raw = _decode_next(state, cap)
+    if raw is None:
+        store = state.frame_store
+        if store and store.finish():
+            # 首轮已完整存入内存：释放解码器，此后循环完全从内存播放
+            state.video_cap = None
+            cap.release()
+            return next_video_frame(state)
+        state.frame_store = None
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        raw = _decode_next(state, cap)
+        if raw is None: return None
+    return apply_brightness(state, raw)
+
+class FrameProducer:
+    # 主循环的取帧部分：按当前模式产出下一帧编码好的数据（没有新内容时为 None）。
+    # 与等待/提交分开，基准测试可直接驱动同一套逻辑
+    def __init__(self, state, renderer, scheduler, monitor):
+        self.state = state
+        self.renderer = renderer
+        self.scheduler = scheduler
+        self.monitor = monitor
+        self.last_mode, self.last_conn, self.static_key = None, None, None
+
+    def produce(self):
+        # 返回 (buf, next_change)；next_change 为动图下一次换帧的单调时间
+        state, renderer, scheduler = self.state, self.renderer, self.scheduler
+        buf, next_change = None, None
+        # 持锁取帧：后台换源会等这一帧取完再替换
+        with state.lock:
+            connections = scheduler.pipeline.connections
+            if state.mode != self.last_mode or connections != self.last_conn:
+                # 切换模式或设备重连后，需要重新推送完整画面
+                renderer.invalidate()
+                scheduler.reset_media()
+                self.last_mode, self.last_conn, self.static_key = state.mode, connections, None
+                if state.stream: state.stream.rewind()
+
+            if state.mode == "MONITOR":
+                start = time.perf_counter()
+                dirty = renderer.render(self.monitor, state.encoder)
+                state.perf.record("render", time.perf_counter() - start)
+                if dirty: buf = bytes(renderer.frame)
+            elif state.mode == "STATIC":
+                # 静态图只在图片或亮度变化时编码一次
+                key = (state.media_version, state.encoder.level)
+                if state.static_image and key != self.static_key:
+                    start = time.perf_counter()
+                    buf = state.encoder.encode(state.static_image)
+                    state.perf.record("encode", time.perf_counter() - start)
+                    self.static_key = key
+            elif state.mode == "VIDEO":
+                skip = scheduler.frames_to_skip(state.media_version, state.video_fps)
+                buf = next_video_frame(state, skip)
+            elif state.mode == "ANIMATION":
+                anim = state.animation
+                if anim:
+                    idx, remaining = anim.frame_at(scheduler.media_time(state.media_version))
+                    next_change = time.monotonic() + remaining
+                    key = (state.media_version, state.encoder.level, idx)
+                    if key != self.static_key:
+                        buf = apply_brightness(state, anim.frame(idx))
+                        self.static_key = key
+            elif state.mode == "STREAM":
+                stream = state.stream
+                if stream:
+                    start = time.perf_counter()
+                    buf = stream.read(state.encoder)
+                    if buf is not None: state.perf.record("acquire", time.perf_counter() - start)
+        return buf, next_change
+
+    def fps(self):
+        state = self.state
+        if state.mode == "VIDEO": return state.video_fps
+        if state.mode == "STREAM": return STREAM_POLL_HZ
+        return state.monitor_fps
+
+# --- 多屏 ---
+# 单独控制某块屏时需要分出的设置项（保存在 settings.json 的 channels.<屏名> 下）
+CHANNEL_KEYS = ("mode", "media_path", "brightness", "monitor_fps", "playlist")
+
+class Channel:
+    # 一路显示内容：一个 ServiceState + 取帧循环，帧分发给 fanout 里的所有屏
+    def __init__(self, state, fanout, monitor, screen):
+        self.state, self.fanout = state, fanout
+        self.scheduler = FrameScheduler(fanout, state.perf)
+        self.producer = FrameProducer(state, MonitorRenderer(screen), self.scheduler, monitor)
+        state.monitor, state.pipeline, state.scheduler = monitor, fanout, self.scheduler
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.scheduler.wake()
+        if self.thread: self.thread.join(2.0)
+
+    def invalidate(self):
+        # 下一帧重推完整画面（静态内容不会再自己出新帧）
+        self.fanout.version += 1
+        self.scheduler.wake()
+
+    def run(self, t_start=None):
+        producer, scheduler, fanout = self.producer, self.scheduler, self.fanout
+        while not self.stopped.is_set():
+            if not fanout.pipelines:
+                # 所有屏都分出去了，默认内容没人看
+                scheduler.wait(1.0 / producer.fps())
+                continue
+            t0 = time.perf_counter()
+            buf, next_change = producer.produce()
+
+            if buf is not None:
+                fanout.submit(buf, time.perf_counter() - t0)
+                if t_start is not None:
+                    print(f"First frame after {time.monotonic() - t_start:.2f}s")
+                    t_start = None
+
+            if next_change is not None:
+                scheduler.wait_until(next_change)
+                continue
+            scheduler.wait(scheduler.interval(producer.fps()))
+
+class DisplayManager:
+    # devices: 屏名 -> FramePipeline（各自的队列、写线程、连接状态与重连）。
+    # 默认所有屏共享一路内容 channels[None]；带 device 的改变内容命令把该屏分出到它自己的频道
+    # （独立取帧线程），share 再并回共享内容
+    def __init__(self, state, monitor, pipelines):
+        self.monitor = monitor
+        self.lock = threading.Lock()
+        self.devices = {p.name: p for p in pipelines}
+        saved = load_settings().get("channels") or {}
+        shared = [p for p in pipelines if p.name not in saved]
+        self.channels = {None: Channel(state, FanOut(shared), monitor, pipelines[0].screen)}
+        panels = load_settings().get("panels") or {}
+        for p in pipelines:
+            p.set_brightness(panels.get(p.name, {}).get("brightness", 1.0))
+            p.start()
+        for name in saved:
+            if name in self.devices: self._open(name)
+
+    @property
+    def default(self):
+        return self.channels[None]
+
+    def _open(self, name):
+        pipeline = self.devices[name]
+        channel = Channel(ServiceState(name, self.default.state.frame_cache), FanOut([pipeline]), self.monitor, pipeline.screen).start()
+        self.channels[name] = channel
+        return channel
+
+    def state_for(self, name, fork=False):
+        # fork 为 False 时共享中的屏返回默认内容的状态（只读查询用）
+        channel = self.channels.get(name)
+        if channel: return channel.state
+        if not fork: return self.default.state
+        with self.lock:
+            if name in self.channels: return self.channels[name].state
+            # 分出时先沿用当前共享的内容，之后的命令只影响这块屏
+            settings = self.default.state.settings()
+            SETTINGS.update_section("channels", name, {k: settings[k] for k in CHANNEL_KEYS if k in settings})
+            self.default.fanout.remove(self.devices[name])
+            return self._open(name).state
+
+    def share(self, name):
+        with self.lock:
+            channel = self.channels.pop(name, None)
+            if not channel: return False
+            channel.stop()
+            channel.state.stop_playlist(persist=False)
+            channel.state._cleanup()
+            self.default.fanout.add(self.devices[name])
+            SETTINGS.update_section("channels", name, None)
+            return True
+
+    def set_panel_brightness(self, name, level):
+        self.devices[name].set_brightness(level)
+        (self.channels.get(name) or self.default).invalidate()
+        SETTINGS.update_section("panels", name, {"brightness": level})
+
+    def collect_stats(self, histogram=False):
+        res = collect_stats(self.default.state, histogram)
+        own = {name: collect_stats(ch.state, histogram) for name, ch in list(self.channels.items()) if name is not None}
+        if own: res["channels"] = own
+        return res
+
+    def snapshot(self):
+        channels = self.channels
+        return [{"name": name, "shared": name not in channels, "match": p.screen.match,
+                 "backend": type(p.screen.backend).__name__ if p.screen.backend else "usb",
+                 "connected": p.screen.ep_out is not None, "mode": self.state_for(name).mode,
+                 "brightness": p.brightness} for name, p in self.devices.items()]
 
 # --- Socket Server ---
-def server_thread(state):
-    if os.path.exists(SOCKET_PATH):
-        try: os.unlink(SOCKET_PATH)
-        except: pass
-    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    server.bind(SOCKET_PATH)
-    server.listen(1)
-    os.chmod(SOCKET_PATH, 0o666)
+# 协议：每条消息为 4 字节大端长度 + JSON；同一连接可连续发送多条（流水线），
+# 响应按请求顺序返回，请求中带 "id" 时原样回带。
+# 兼容旧客户端：首字节为 '{' 时按旧协议处理（裸 JSON，一问一答后关闭）。
+# 多屏：命令带 "device": "<屏名>" 时只作用于该屏，不带时作用于所有共享内容的屏。
+# 只有改变内容的命令会把共享中的屏分出去；带 device 的亮度只调这块屏的写线程，不分出
+SLOW_ACTIONS = {"media", "playlist", "share"}
+MODE_ACTIONS = {"monitor", "media", "stream", "playlist", "share"}
+CONTENT_ACTIONS = {"monitor", "media", "stream", "playlist"}
+
+def collect_stats(state, histogram=False, device=None):
+    # 'stats' 动作与定期落盘共用：各阶段耗时分布 + 单调递增的计数器。
+    # 设备相关的阶段和计数为该路内容下各屏合计（device 指定时只算这块屏），另附每屏明细
+    stages = dict(state.perf.stages)
+    counters = {"ram_hits": state.ram_stats["hits"], "ram_misses": state.ram_stats["misses"]}
+    last_error, devices = None, {}
+    fanout = state.pipeline
+    if fanout:
+        pipelines = [p for p in fanout.pipelines if device is None or p.name == device]
+        stages.update({"hash": StageStats.merged(p.screen.hash_stats for p in pipelines),
+                       "usb_write": StageStats.merged(p.screen.transfer_stats for p in pipelines),
+                       "produce": fanout.produce_stats, "write": StageStats.merged(p.write_stats for p in pipelines)})
+        counters["frames_produced"] = fanout.produce_stats.count
+        for p in pipelines:
+            devices[p.name] = {**p.counters(), "connected": p.screen.ep_out is not None,
+                               "usb_write": p.screen.transfer_stats.snapshot(histogram), "last_error": p.screen.last_error}
+            for k, v in p.counters().items(): counters[k] = counters.get(k, 0) + v
+            last_error = last_error or p.screen.last_error
+    if state.scheduler: counters.update({"late": state.scheduler.late, "skipped": state.scheduler.skipped})
+    return {"uptime_s": round(time.monotonic() - state.perf.started, 1), "mode": state.mode,
+            "stages": {name: st.snapshot(histogram) for name, st in stages.items()},
+            "counters": counters, "devices": devices, "last_error": last_error}
+
+def reset_stats(state, device=None):
+    # 只清空耗时分布（便于按时间窗口观察），计数器保持单调递增。
+    # 指定 device 时只清这块屏的；取帧端的阶段由同一路内容的各屏共用，还有别的屏在用时保留
+    fanout = state.pipeline
+    pipelines = [p for p in fanout.pipelines if device is None or p.name == device] if fanout else []
+    if device is None or not fanout or len(fanout.pipelines) <= 1:
+        state.perf.reset()
+        if fanout: fanout.produce_stats.reset()
+    for p in pipelines:
+        for st in (p.screen.hash_stats, p.screen.transfer_stats, p.produce_stats, p.write_stats): st.reset()
+
+def stats_dump_thread(manager, path, interval):
+    # 定期把统计追加为一行 JSON，便于长期趋势分析（每次重新打开文件，兼容 logrotate）
     while True:
+        time.sleep(interval)
         try:
-            conn, _ = server.accept()
-            data = conn.recv(4096)
-            if data:
-                cmd = json.loads(data.decode())
-                act = cmd.get('action')
-                res = {"status": "ok"}
-                if act == 'monitor':
-                    state.mode = "MONITOR"
-                    state._cleanup()
-                    update_settings({"mode": "MONITOR"})
-                elif act == 'media':
-                    success, msg = state.set_media(cmd.get('path'))
-                    if not success: res = {"status": "error", "message": msg}
-                elif act == 'brightness':
-                    val = max(0.0, min(1.0, cmd.get('value', 100) / 100.0))
-                    state.brightness = val
-                    update_settings({"brightness": val})
-                conn.send(json.dumps(res).encode())
-            conn.close()
-        except: pass
+            with open(path, 'a') as f: f.write(json.dumps({"time": round(time.time(), 1), **manager.collect_stats()}) + "\n")
+        except OSError as e: print(f"Stats dump failed: {e}")
+
+def handle_command(state, cmd, cancelled=None):
+    act = cmd.get('action')
+    res = {"status": "ok"}
+    if act == 'monitor':
+        state.stop_playlist()
+        state.show_monitor()
+    elif act == 'media':
+        success, msg = state.set_media(cmd.get('path'), decoder=cmd.get('decoder'), cancelled=cancelled)
+        if not success: res = {"status": "error", "message": msg}
+    elif act == 'playlist':
+        if cmd.get('items') is None:
+            state.stop_playlist()
+        else:
+            success, msg = state.set_playlist(cmd['items'], cmd.get('loop', True))
+            res = {"status": "ok", "message": msg} if success else {"status": "error", "message": msg}
+    elif act == 'stream':
+        success, msg = state.set_stream(cmd.get('path', ''))
+        res = {"status": "ok", "message": msg} if success else {"status": "error", "message": msg}
+    elif act == 'brightness':
+        val = max(0.0, min(1.0, cmd.get('value', 100) / 100.0))
+        state.set_brightness(val)
+        state.save({"brightness": val})
+    elif act == 'rate':
+        val = max(0.1, min(60.0, float(cmd.get('value', 5))))
+        state.monitor_fps = val
+        state.save({"monitor_fps": val})
+    elif act == 'status':
+        res["mode"] = state.mode
+        res["brightness"] = state.brightness
+        res["monitor_fps"] = state.monitor_fps
+        if state.pipeline: res["pipeline"] = state.pipeline.snapshot()
+        if state.scheduler: res["scheduler"] = state.scheduler.snapshot()
+        if state.stream: res["stream"] = state.stream.snapshot()
+        playlist = state.playlist
+        if playlist: res["playlist"] = playlist.snapshot()
+        res["ram_cache"] = state.ram_snapshot()
+        if state.video_cap: res["decoder"] = state.video_decoder
+        if state.animation: res["animation"] = {"frames": state.animation.frame_count, "loop_s": round(state.animation.total, 3), "bytes": len(state.animation.data)}
+        if state.monitor:
+            m = state.monitor
+            res["sensors"] = {"usage": m.get_cpu_usage(), "temp": m.get_cpu_temp(), "power": round(m.get_cpu_power(), 2)}
+    elif act == 'stats':
+        res.update(collect_stats(state, bool(cmd.get('histogram')), cmd.get('device')))
+        if cmd.get('reset'): reset_stats(state, cmd.get('device'))
+    elif act == 'history':
+        if not state.monitor: res = {"status": "error", "message": "Monitor not running"}
+        else:
+            try: res["values"] = [round(v, 2) for v in state.monitor.get_history(cmd.get('metric', 'usage'), cmd.get('tier', '1m'), int(cmd.get('count', 60)))]
+            except KeyError: res = {"status": "error", "message": "Unknown metric or tier"}
+    else:
+        res = {"status": "error", "message": f"Unknown action: {act}"}
+    return res
+
+class _Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.rbuf = bytearray()
+        self.wbuf = bytearray()
+        self.pending = deque()  # 按请求顺序排队的响应槽 [响应 或 None(未完成)]
+        self.legacy = None
+        self.legacy_done = False
+        self.eof = False
+        self.events = selectors.EVENT_READ
+
+class ControlServer:
+    # selectors 事件循环：多客户端、长连接、流水线请求；
+    # 慢操作（加载媒体）交给单线程池串行执行，不阻塞其他命令
+    MAX_FRAME = 16 << 20
+
+    def __init__(self, state, path=None, manager=None):
+        self.state = state
+        self.manager = manager
+        self.path = path or SOCKET_PATH
+        self.sel = selectors.DefaultSelector()
+        self.slow = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-loader")
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.completed = deque()
+        self.mode_seq = {}  # 按目标屏计数（None 为共享内容）：每条改变显示内容的命令 +1，排队中已过时的加载直接跳过
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            try: os.unlink(self.path)
+            except OSError: pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(16)
+        os.chmod(self.path, 0o666)
+        server.setblocking(False)
+        self.wake_r.setblocking(False)
+        self.sel.register(server, selectors.EVENT_READ, "accept")
+        self.sel.register(self.wake_r, selectors.EVENT_READ, "wake")
+        while True:
+            for key, mask in self.sel.select():
+                try:
+                    if key.data == "accept": self._accept(key.fileobj)
+                    elif key.data == "wake": self._drain_completed()
+                    else:
+                        if mask & selectors.EVENT_READ: self._read(key.data)
+                        if mask & selectors.EVENT_WRITE: self._flush(key.data)
+                except Exception as e:
+                    print(f"Control socket error: {e}")
+                    if isinstance(key.data, _Connection): self._close(key.data)
+
+    def _accept(self, server):
+        sock, _ = server.accept()
+        sock.setblocking(False)
+        self.sel.register(sock, selectors.EVENT_READ, _Connection(sock))
+
+    def _close(self, conn):
+        if conn.events: self.sel.unregister(conn.sock)
+        conn.events = 0
+        conn.sock.close()
+
+    def _set_events(self, conn, events):
+        # 读到 EOF 后不再监听可读，否则会空转；没有任何事件时暂时注销，等慢操作完成再注册
+        if events == conn.events: return
+        if not events: self.sel.unregister(conn.sock)
+        elif not conn.events: self.sel.register(conn.sock, events, conn)
+        else: self.sel.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def _read(self, conn):
+        try: data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError): return
+        except OSError: data = b""
+        if not data:
+            conn.eof = True
+            self._flush(conn)
+            return
+        conn.rbuf += data
+        if conn.legacy is None: conn.legacy = conn.rbuf[:1] == b"{"
+        if conn.legacy: self._parse_legacy(conn)
+        else: self._parse_frames(conn)
+        self._flush(conn)
+
+    def _parse_legacy(self, conn):
+        # 旧协议只处理一条命令，之后收到的数据丢弃
+        if conn.legacy_done:
+            conn.rbuf.clear()
+            return
+        try: cmd = json.loads(conn.rbuf.decode())
+        except (UnicodeDecodeError, ValueError):
+            if len(conn.rbuf) < 4096: return  # 可能还没收完
+            cmd = None
+        conn.rbuf.clear()
+        conn.legacy_done = True
+        self._dispatch(conn, cmd)
+
+    def _parse_frames(self, conn):
+        while len(conn.rbuf) >= 4:
+            n = int.from_bytes(conn.rbuf[:4], "big")
+            if n > self.MAX_FRAME:
+                conn.pending.append({"status": "error", "message": "Frame too large"})
+                conn.rbuf.clear()
+                conn.eof = True
+                return
+            if len(conn.rbuf) < 4 + n: return
+            payload = bytes(conn.rbuf[4:4 + n])
+            del conn.rbuf[:4 + n]
+            try: cmd = json.loads(payload.decode())
+            except (UnicodeDecodeError, ValueError): cmd = None
+            self._dispatch(conn, cmd)
+
+    def _dispatch(self, conn, cmd):
+        if not isinstance(cmd, dict):
+            conn.pending.append({"status": "error", "message": "Invalid JSON"})
+            return
+        act, device = cmd.get('action'), cmd.get('device')
+        error = None
+        if device is not None and (not self.manager or device not in self.manager.devices): error = f"Unknown device: {device}"
+        elif act == "share" and device is None: error = "share needs a device"
+        if error:
+            res = {"status": "error", "message": error}
+            if "id" in cmd: res["id"] = cmd["id"]
+            conn.pending.append(res)
+            return
+        key = device if act in MODE_ACTIONS else None
+        if act in MODE_ACTIONS: self.mode_seq[key] = self.mode_seq.get(key, 0) + 1
+        seq = self.mode_seq.get(key) if act in MODE_ACTIONS else None
+        # 共享中的屏第一次单独设置内容时要分出新频道（可能要加载上次的媒体），也放到后台串行执行
+        forks = device is not None and act in CONTENT_ACTIONS and device not in self.manager.channels
+        if act in SLOW_ACTIONS or forks:
+            slot = [None]
+            conn.pending.append(slot)
+            future = self.slow.submit(self._run_slow, cmd, key, seq)
+            future.add_done_callback(lambda f, conn=conn, slot=slot: self._complete(conn, slot, f))
+            return
+        state = self._state(device)
+        if device is not None and act == "brightness":
+            level = max(0.0, min(1.0, cmd.get('value', 100) / 100.0))
+            self.manager.set_panel_brightness(device, level)
+            res = {"status": "ok"}
+        elif device is not None and act == "rate" and device not in self.manager.channels:
+            res = {"status": "error", "message": f"{device} shows the shared content; set the rate without a device"}
+        elif act == "monitor":
+            # 立即切到监控画面；释放媒体资源排在加载队列之后，保证顺序。
+            # 停止轮播要在这里落盘，之后的慢操作看到的 playlist 已经是 None
+            state.stop_playlist()
+            state.mode = "MONITOR"
+            self.slow.submit(self._run_slow, cmd, key, seq)
+            res = {"status": "ok"}
+        else:
+            try: res = handle_command(state, cmd)
+            except Exception as e: res = {"status": "error", "message": str(e)}
+            if act == "status" and self.manager: res["devices"] = self.manager.snapshot()
+        if "id" in cmd: res["id"] = cmd["id"]
+        conn.pending.append(res)
+
+    def _state(self, device, fork=False):
+        if device is None or not self.manager: return self.state
+        return self.manager.state_for(device, fork)
+
+    def _run_slow(self, cmd, key, seq):
+        current = lambda: seq is None or seq == self.mode_seq.get(key)
+        if not current(): return {"status": "error", "message": "Superseded by a newer command"}
+        if cmd.get('action') == "share":
+            res = {"status": "ok", "message": "Device now shows shared content" if self.manager.share(key) else "Device already shared"}
+        else: res = handle_command(self._state(cmd.get('device'), fork=True), cmd, cancelled=lambda: not current())
+        if "id" in cmd: res["id"] = cmd["id"]
+        return res
+
+    def _complete(self, conn, slot, future):
+        # 在线程池中调用：把结果交回事件循环
+        try: slot[0] = future.result()
+        except Exception as e: slot[0] = {"status": "error", "message": str(e)}
+        self.completed.append(conn)
+        try: self.wake_w.send(b"\0")
+        except OSError: pass
+
+    def _drain_completed(self):
+        try: self.wake_r.recv(4096)
+        except (BlockingIOError, InterruptedError): pass
+        while self.completed: self._flush(self.completed.popleft())
+
+    def _flush(self, conn):
+        if conn.sock.fileno() < 0: return
+        while conn.pending:
+            head = conn.pending[0]
+            if isinstance(head, list):
+                if head[0] is None: break
+                head = head[0]
+            conn.pending.popleft()
+            body = json.dumps(head).encode()
+            conn.wbuf += body if conn.legacy else len(body).to_bytes(4, "big") + body
+        if conn.wbuf:
+            try:
+                sent = conn.sock.send(conn.wbuf)
+                del conn.wbuf[:sent]
+            except (BlockingIOError, InterruptedError): pass
+            except OSError:
+                self._close(conn)
+                return
+        if not conn.pending and not conn.wbuf and (conn.eof or (conn.legacy and conn.legacy_done)):
+            self._close(conn)
+            return
+        events = 0 if conn.eof else selectors.EVENT_READ
+        if conn.wbuf: events |= selectors.EVENT_WRITE
+        self._set_events(conn, events)
+
+def server_thread(state, manager=None):
+    ControlServer(state, manager=manager).serve_forever()
 
 # --- Client ---
-def send_cmd(payload):
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk: raise ConnectionError("Connection closed by server")
+        buf += chunk
+    return bytes(buf)
+
+def request(payloads):
+    # 一个连接里流水线发送全部命令，再按顺序读取响应（原始 JSON 文本）
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET_PATH)
+        for payload in payloads:
+            body = json.dumps(payload).encode()
+            client.sendall(len(body).to_bytes(4, "big") + body)
+        replies = []
+        for _ in payloads:
+            n = int.from_bytes(_recv_exact(client, 4), "big")
+            replies.append(_recv_exact(client, n).decode())
+        return replies
+    finally: client.close()
+
+def send_cmds(payloads):
     if not os.path.exists(SOCKET_PATH):
         print("Error: Service not running")
         return
     try:
-        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        client.connect(SOCKET_PATH)
-        client.send(json.dumps(payload).encode())
-        print("Server:", client.recv(4096).decode())
-        client.close()
+        for reply in request(payloads): print("Server:", reply)
     except Exception as e: print(f"Connection failed: {e}")
 
+def send_cmd(payload):
+    send_cmds([payload])
+
+class FrameStreamWriter:
+    # 供外部程序推帧：在 /dev/shm 建环形缓冲并注册到服务，之后 write() 只是一次内存拷贝
+    def __init__(self, name="deepcool-stream", fmt="rgb565", slots=3):
+        fmt_id = 0 if fmt == "rgb565" else 1
+        self.frame_size = STREAM_FORMATS[fmt_id][1]
+        self.slots = slots
+        self.path = f"/dev/shm/{name}"
+        size = STREAM_HEADER_SIZE + slots * self.frame_size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally: os.close(fd)
+        STREAM_HEADER.pack_into(self._map, 0, STREAM_MAGIC, 1, fmt_id, 320, 240, slots)
+        self.seq = 0
+
+    def register(self):
+        return json.loads(request([{"action": "stream", "path": self.path}])[0])
+
+    def write(self, frame):
+        # frame: 320x240 的 RGB565 (小端) 或 RGB888 字节数据 / 数组
+        off = STREAM_HEADER_SIZE + (self.seq % self.slots) * self.frame_size
+        self._map[off:off + self.frame_size] = memoryview(frame).cast("B")
+        self.seq += 1
+        struct.pack_into("<Q", self._map, STREAM_WRITE_SEQ, self.seq)
+
+    def close(self, unlink=True):
+        self._map.close()
+        if unlink:
+            try: os.unlink(self.path)
+            except OSError: pass
+
 # --- Main ---
-def main():
-    if len(sys.argv) > 1 and sys.argv[1] == '--daemon':
-        time.sleep(10)
+def wait_for_hardware(vendor_id=0x3633, product_id=0x0026, timeout=30.0, sensor_grace=3.0, poll=0.1, settle=0.0):
+    # 开机自启时 USB 设备和 hwmon 驱动可能还没就绪：轮询直到屏幕出现，并让传感器最多再多等 sensor_grace 秒。
+    # settle > 0 时（自动发现多屏）还要等屏幕数量连续 settle 秒不变，后枚举出来的屏不会被漏掉。
+    # 超时后照常启动，之后由屏幕重连和传感器热插拔检测接手；返回找到的屏数
+    start = time.monotonic()
+    device_at, sensors, count, changed_at = None, False, 0, start
+    while True:
+        now = time.monotonic()
+        if device_at is None or settle:
+            try: n = len(find_panels(vendor_id, product_id))
+            except Exception: n = count
+            if n != count: count, changed_at = n, now
+            if n and device_at is None: device_at = now
+        sensors = sensors or bool(resolve_temp_sensors())
+        if device_at is not None and (sensors or now - device_at >= sensor_grace) and now - changed_at >= settle: break
+        if now - start >= timeout: break
+        time.sleep(poll)
+    print(f"Hardware ready in {time.monotonic() - start:.2f}s (devices: {count}, sensors: {'yes' if sensors else 'no'})")
+    return count
+
+BACKEND_KINDS = ("null", "file", "mock")
+
+def is_backend(match):
+    return (match or "usb").partition(":")[0] in BACKEND_KINDS
+
+def panel_specs(panels, settings):
+    # [(屏名, match)]：--panel NAME=MATCH 优先，其次 devices 设置 [{"name", "match"}]。
+    # match 为接口路径 / serial:<SN> / usb（任意一块）/ 显示后端（null、file:...、mock:...）
+    if panels:
+        specs = []
+        for item in panels:
+            name, sep, match = item.partition("=")
+            if not sep or not name: raise ValueError(f"Bad --panel {item!r}, expected NAME=MATCH")
+            specs.append((name, match))
+    else: specs = [(d["name"], d.get("match")) for d in settings.get("devices") or []]
+    names = [name for name, _ in specs]
+    if len(set(names)) != len(names): raise ValueError("Duplicate panel name")
+    return specs
+
+def discover_panels():
+    # 未配置时：接了多块屏就按接口路径各自命名
+    try: found = [device_path(dev) for dev in find_panels()]
+    except Exception: found = []
+    return [(path, path) for path in found] if len(found) > 1 else []
+
+def open_panel(name, match, settings):
+    backend = make_endpoint(match) if is_backend(match) else None
+    screen = DeepCoolScreen(header_gap=settings.get("usb_header_gap"), chunk_size=settings.get("usb_chunk_size", 0),
+                            backend=backend, match=None if backend or match in (None, "usb") else match, name=name)
+    return FramePipeline(screen)
 
+def main():
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--daemon", action="store_true")
     group.add_argument("--monitor", action="store_true")
     group.add_argument("--media", type=str, help="Play Image/Video/GIF")
+    group.add_argument("--stream", type=str, help="Attach a shared-memory frame ring in /dev/shm")
+    group.add_argument("--playlist", nargs="+", metavar="ITEM", help="Rotate through media files and 'monitor'")
+    group.add_argument("--stop-playlist", action="store_true", help="Stop the running playlist")
+    group.add_argument("--status", action="store_true", help="Show service status and pipeline metrics")
+    group.add_argument("--stats", action="store_true", help="Show per-stage latency percentiles and counters")
+    group.add_argument("--share", action="store_true", help="Return --device to the shared content")
+    group.add_argument("--list-devices", action="store_true", help="List attached panels (bus-port path and serial)")
     parser.add_argument("--brightness", type=int)
+    group.add_argument("--history", choices=["usage", "temp", "power"], help="Print recorded metric history")
+    parser.add_argument("--tier", choices=["raw", "1s", "1m", "1h"], default="1m", help="History resolution for --history")
+    parser.add_argument("--count", type=int, default=60, help="Number of history points for --history")
+    parser.add_argument("--monitor-fps", type=float, help="Refresh rate of the monitor view")
+    parser.add_argument("--interval", type=float, help="Seconds per playlist item (default: one loop for videos, 30s otherwise)")
+    parser.add_argument("--backend", help="Display backend for --daemon: usb (default), null, file:<path>, mock[:latency=,bandwidth=,error_rate=]")
+    parser.add_argument("--decoder", choices=["auto", "ffmpeg", "opencv"], help="Video decoder for --media")
+    parser.add_argument("--device", help="Send the command to this panel only")
+    parser.add_argument("--panel", action="append", metavar="NAME=MATCH",
+                        help="Panel for --daemon (repeatable); MATCH is a bus-port path, serial:<SN>, usb or a backend spec")
     args = parser.parse_args()
 
-    if args.monitor or args.media or (args.brightness is not None):
-        if args.monitor: send_cmd({"action": "monitor"})
-        if args.media: send_cmd({"action": "media", "path": os.path.abspath(args.media)})
-        if args.brightness is not None: send_cmd({"action": "brightness", "value": args.brightness})
+    if args.list_devices:
+        try: panels = find_panels()
+        except Exception as e: return print(f"USB error: {e}")
+        for dev in panels: print(f"{device_path(dev)}\tserial={device_serial(dev) or '-'}")
+        if not panels: print("No panels found")
+        return
+    if args.share and not args.device: parser.error("--share requires --device")
+
+    cmds = []
+    if args.monitor: cmds.append({"action": "monitor"})
+    if args.media:
+        cmd = {"action": "media", "path": os.path.abspath(args.media)}
+        if args.decoder: cmd["decoder"] = args.decoder
+        cmds.append(cmd)
+    if args.playlist:
+        items = [{"duration": args.interval} if item == "monitor" else {"path": os.path.abspath(item), "duration": args.interval} for item in args.playlist]
+        cmds.append({"action": "playlist", "items": items})
+    if args.stop_playlist: cmds.append({"action": "playlist", "items": None})
+    if args.stream: cmds.append({"action": "stream", "path": os.path.abspath(args.stream)})
+    if args.brightness is not None: cmds.append({"action": "brightness", "value": args.brightness})
+    if args.monitor_fps is not None: cmds.append({"action": "rate", "value": args.monitor_fps})
+    if args.status: cmds.append({"action": "status"})
+    if args.stats: cmds.append({"action": "stats"})
+    if args.history: cmds.append({"action": "history", "metric": args.history, "tier": args.tier, "count": args.count})
+    if args.share: cmds.append({"action": "share"})
+    if args.device:
+        for cmd in cmds: cmd["device"] = args.device
+    if cmds:
+        send_cmds(cmds)
         return
 
     print("DeepCool Service Started...")
+    t_start = time.monotonic()
+    # systemd 停止服务时发 SIGTERM：转成正常退出，让 atexit 里的设置落盘能执行；
+    # 之后再来的 SIGTERM 忽略，避免在落盘中途再次抛出 SystemExit
+    def on_sigterm(*_):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    settings = load_settings()
+    backend = args.backend or settings.get("display_backend")
+    if backend and backend != "usb" and not is_backend(backend): parser.error(f"Unknown display backend: {backend}")
+    try: specs = panel_specs(args.panel, settings)
+    except (ValueError, TypeError, KeyError) as e: parser.error(str(e))
+    # 全是模拟后端时不用等 USB；自动发现多屏要等屏幕数量稳定下来（都枚举完）
+    if not all(is_backend(match) for _, match in specs or [("default", backend)]):
+        wait_for_hardware(timeout=settings.get("startup_timeout", 30.0), settle=0.0 if specs else 1.0)
+    if not specs: specs = ([] if is_backend(backend) else discover_panels()) or [("default", backend)]
+    try: pipelines = [open_panel(name, match, settings) for name, match in specs]
+    except (ValueError, TypeError, OSError) as e: parser.error(str(e))
+    if len(pipelines) > 1: print(f"Panels: {', '.join(p.name for p in pipelines)}")
     state, monitor = ServiceState(), SystemMonitor()
-    screen = DeepCoolScreen()
+    state.frame_cache.evict()  # 清掉上次被强杀时留下的转码临时文件
+    monitor.start_sampler()
+    manager = DisplayManager(state, monitor, pipelines)
 
-    t = threading.Thread(target=server_thread, args=(state,), daemon=True)
+    t = threading.Thread(target=server_thread, args=(state, manager), daemon=True)
     t.start()
+    if settings.get("stats_file"):
+        threading.Thread(target=stats_dump_thread, args=(manager, settings["stats_file"], settings.get("stats_interval", 60)), daemon=True).start()
 
-    # 恢复 5Hz (0.2s)
-    TARGET_INTERVAL = 0.2
-
-    try:
-        while True:
-            start = time.time()
-            img = None
-
-            if state.mode == "MONITOR":
-                img = draw_monitor_ui(screen, monitor)
-            elif state.mode == "STATIC":
-                if state.static_image: img = state.static_image.copy()
-            elif state.mode == "VIDEO":
-                if state.video_cap and state.video_cap.isOpened():
-                    ret, frame = state.video_cap.read()
-                    if not ret:
-                        state.video_cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                        ret, frame = state.video_cap.read()
-                    if ret:
-                        img = process_frame_cv2(frame, 320, 240, mode='contain')
-
-            if img:
-                if state.brightness < 1.0:
-                    img = ImageEnhance.Brightness(img).enhance(state.brightness)
-                screen.display(img)
-
-            wait = 0
-            if state.mode == "VIDEO":
-                wait = (1.0 / state.video_fps) - (time.time() - start)
-            else:
-                wait = TARGET_INTERVAL - (time.time() - start)
-
-            if wait > 0: time.sleep(wait)
+    # 共享内容的取帧循环跑在主线程，单独控制的屏各有自己的线程
+    try: manager.default.run(t_start)
     except KeyboardInterrupt: pass
     finally:
         if os.path.exists(SOCKET_PATH): os.unlink(SOCKET_PATH)